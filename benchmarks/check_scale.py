@@ -0,0 +1,261 @@
+# Time, query count and scan volume of every check on the synthetic CDM at growing scales, and
+# the check results compared with the errors synthetic_cdm injected.
+#
+#   python benchmarks/check_scale.py --root /tmp/edc_synthetic --rows 100000 1000000 > bench_output.txt
+#
+# Runs on DuckDB over the generated Parquet. "rows scanned" comes from DuckDB's query profile;
+# "MB scanned" is the compressed Parquet size of the columns each statement names in the tables
+# it reads, an upper bound since row-group pruning is not accounted for. Exits 1 when a check
+# disagrees with the manifest, so rewritten SQL can be checked for equivalence at any scale.
+import argparse
+import itertools
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from datetime import date
+from functools import partial
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'edc_check_streamlit_app'))
+
+from synthetic_cdm import default_chunk_rows, generate_cdm, read_manifest, rate_arguments, parsed_rates  # noqa: E402
+from backends import DuckDBSession, DuckDBStatement  # noqa: E402
+from check_registry import table_dict, years_before  # noqa: E402
+from demographic_summary import submit_demographic_summary  # noqa: E402
+from integrity_checks import submit_required_checks  # noqa: E402
+from patient_pools import submit_potential_pools  # noqa: E402
+from persistence import submit_table_changes, submit_encounter_type_changes, submit_code_type_changes  # noqa: E402
+from result_store import open_store, clear_store  # noqa: E402
+from refresh_profile import submit_profiled_changes  # noqa: E402
+from query_executor import default_max_concurrency, defer, make_executor, resolve  # noqa: E402
+from report import run_report  # noqa: E402
+from trend_rollup import fetch_rollup, fetch_overview  # noqa: E402
+
+
+# the previous refresh is generated this much smaller, so Table VA shows a known change
+previous_scale = 0.97
+
+
+class ProfiledStatement(DuckDBStatement):
+
+    def collect(self):
+        rows = super().collect()
+        self._session.record(self._sql, self._session.last_profile())
+        return rows
+
+
+class ProfiledSession(DuckDBSession):
+    # a DuckDBSession that profiles every statement and adds the counts up until reset()
+
+    def __init__(self, root, profile_dir):
+        self._profile_dir = profile_dir
+        self._profile_numbers = itertools.count()
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.column_bytes = {}
+        self.reset()
+        super().__init__(root)
+
+    def attach_schema(self, schema):
+        super().attach_schema(schema)
+        directory = os.path.join(self.root, schema)
+        for entry in os.listdir(directory):
+            path = os.path.join(directory, entry)
+            files = os.path.join(path, '*.parquet') if os.path.isdir(path) else path
+            if not files.endswith('.parquet'):
+                continue
+            table = entry[:-len('.parquet')] if entry.endswith('.parquet') else entry
+            sizes = self._connection.execute(
+                f"SELECT path_in_schema, SUM(total_compressed_size) FROM parquet_metadata('{files}') GROUP BY 1").fetchall()
+            self.column_bytes[(schema.upper(), table.upper())] = {column.upper(): size for column, size in sizes}
+
+    def cursor(self):
+        cursor = super().cursor()
+        path = os.path.join(self._profile_dir, f"{next(self._profile_numbers)}.json")
+        cursor.execute("PRAGMA enable_profiling='json'")
+        cursor.execute(f"PRAGMA profiling_output='{path}'")
+        self._local.profile = path
+        return cursor
+
+    def last_profile(self):
+        with open(self._local.profile) as f:
+            profile = json.load(f)
+        os.remove(self._local.profile)
+        return profile
+
+    def scanned_bytes(self, sql):
+        names = {word.upper() for word in re.findall(r'\w+', sql)}
+        select_all = re.search(r'SELECT\s+\*', sql, re.I) is not None
+        total = 0
+        for (schema, table), columns in self.column_bytes.items():
+            if re.search(rf'\b{schema}\.{table}\b', sql, re.I):
+                total += sum(size for column, size in columns.items() if select_all or column in names)
+        return total
+
+    def record(self, sql, profile):
+        with self._stats_lock:
+            self.queries += 1
+            self.rows_scanned += profile.get('cumulative_rows_scanned', 0)
+            self.bytes_scanned += self.scanned_bytes(sql)
+
+    def reset(self):
+        self.queries = 0
+        self.rows_scanned = 0
+        self.bytes_scanned = 0
+
+    def sql(self, sql):
+        return ProfiledStatement(self, sql)
+
+
+def trend_rollups(executor, session, schema, start_date, end_date):
+    tables = [table for table in table_dict if table_dict[table]]
+    calls = [partial(fetch_rollup, session, schema, table, start_date, end_date, {}) for table in tables]
+    return defer(executor, calls, lambda results: dict(zip(tables, results)))
+
+
+def trend_overview(executor, session, schema, start_date, end_date):
+    # the whole years trend_rollups covers, so the totals can be compared
+    call = partial(fetch_overview, session, schema, date(start_date.year, 1, 1), date(end_date.year, 12, 31))
+    return defer(executor, [call], lambda results: results[0])
+
+
+def profiled_changes(session, current_schema, last_schema, cutoff_date, store, label, executor, fresh=False):
+    # fresh empties the store first, so every repeat pays for profiling both schemas
+    if fresh:
+        clear_store(store)
+    return {f"{section} {label}": deferred for section, deferred in
+            submit_profiled_changes(executor, session, current_schema, last_schema, cutoff_date, store).items()}
+
+
+def benchmark_units(session, current_schema, last_schema, cutoff_date, start_date, profile_store):
+    # unit name -> submit(executor) returning {check id: Deferred}; the required checks share
+    # one planner pass and are timed together. Refresh profiles are timed when first computed
+    # into an empty store and again when read back from it
+    lookback = years_before(cutoff_date, 10)
+    return {
+        'IA demographic summary': lambda executor: {'IA': submit_demographic_summary(executor, session, current_schema)},
+        'IB potential pools': lambda executor: {'IB': submit_potential_pools(executor, session, current_schema, years_before(cutoff_date, 5).isoformat(),
+                                                                             years_before(cutoff_date, 1).isoformat())},
+        'IIA/IIE required checks': lambda executor: submit_required_checks(executor, session, current_schema, lookback),
+        'VA table changes': lambda executor: {'VA': submit_table_changes(executor, session, current_schema, last_schema, lookback)},
+        'VB encounter types': lambda executor: {'VB': submit_encounter_type_changes(executor, session, current_schema, last_schema, lookback)},
+        'VC code types': lambda executor: {'VC': submit_code_type_changes(executor, session, current_schema, last_schema, lookback)},
+        'VA-VC profiling': partial(profiled_changes, session, current_schema, last_schema, lookback, profile_store, 'profiles', fresh=True),
+        'VA-VC stored profiles': partial(profiled_changes, session, current_schema, last_schema, years_before(lookback, -1), profile_store, 'stored profiles'),
+        'trend rollups': lambda executor: {'trend': trend_rollups(executor, session, current_schema, start_date, cutoff_date)},
+        'trend overview': lambda executor: {'overview': trend_overview(executor, session, current_schema, start_date, cutoff_date)},
+    }
+
+
+def timed_unit(session, submit, max_concurrency, repeat):
+    best = None
+    for _ in range(repeat):
+        session.reset()
+        started = time.perf_counter()
+        with make_executor(max_concurrency) as executor:
+            results = {check: resolve(deferred) for check, deferred in submit(executor).items()}
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best[0]:
+            best = (elapsed, session.queries, session.rows_scanned, session.bytes_scanned)
+    return best, results
+
+
+def compare(mismatches, label, actual, expected):
+    if actual != expected:
+        mismatches.append(f"{label}: got {actual}, expected {expected}")
+
+
+def verify(results, current_manifest, last_manifest):
+    # the injected errors are the only ones in the data, so every count is known exactly
+    mismatches = []
+    expected = current_manifest['expected']
+    for row in results['1.05']:
+        compare(mismatches, f"1.05 {row['TABLE']}", row['Exception to specifications'], expected['1.05'][row['TABLE']])
+    for check in ('1.08', '1.09', '1.10', '1.11', '1.12'):
+        counts = {row['TABLE']: int(row['Count']) for row in results[check]}
+        compare(mismatches, check, counts, expected[check])
+    for row in results['VA']:
+        table = row['TABLE_NAME']
+        compare(mismatches, f"VA {table} current records", row['CURRENT_RECORD'], expected['records'][table])
+        compare(mismatches, f"VA {table} previous records", row['PREVIOUS_RECORD'], last_manifest['expected']['records'][table])
+    for section in ('VA', 'VB', 'VC'):
+        if results[f"{section} profiles"] != results[section]:
+            mismatches.append(f"{section} from refresh profiles differs from the scanning check")
+    overview = {}
+    for row in results['overview']:
+        overview[row['TABLE_NAME']] = overview.get(row['TABLE_NAME'], 0) + int(row['RECORDS'])
+    rollups = {table: sum(int(row['RECORDS']) for row in rows if row['GRAIN'] == 'YEAR') for table, rows in results['trend'].items()}
+    compare(mismatches, "trend overview records", overview, {table: records for table, records in rollups.items() if records})
+    patients = next(row['N'] for row in results['IA'] if row['CATEGORY'] == 'Patients')
+    compare(mismatches, "IA patients", int(patients), expected['patients'])
+    return mismatches
+
+
+def prepared_schema(args, schema, rows, seed):
+    manifest = read_manifest(args.root, schema)
+    wanted = {'rows': rows, 'seed': seed, 'rates': parsed_rates(args), 'end_date': str(args.end_date)}
+    if manifest and not args.regenerate and all(manifest[key] == value for key, value in wanted.items()):
+        return manifest, 0.0
+    started = time.perf_counter()
+    manifest = generate_cdm(args.root, schema, rows, parsed_rates(args), seed, end_date=args.end_date, chunk_rows=args.chunk_rows)
+    return manifest, time.perf_counter() - started
+
+
+def run_scale(args, rows):
+    current_schema, last_schema = f"SYNTH_{rows}", f"SYNTH_{rows}_PREVIOUS"
+    current_manifest, generate_seconds = prepared_schema(args, current_schema, rows, args.seed)
+    last_manifest, last_seconds = prepared_schema(args, last_schema, round(rows * previous_scale), args.seed)
+    print(f"\n{rows} rows ({current_schema}, generated in {generate_seconds + last_seconds:.1f} s)")
+    print(f"{'unit':<26} {'seconds':>9} {'queries':>8} {'rows scanned':>14} {'MB scanned':>11}")
+
+    cutoff_date = args.end_date
+    start_date = years_before(cutoff_date, 9)
+    results = {}
+    with tempfile.TemporaryDirectory() as profile_dir:
+        session = ProfiledSession(args.root, profile_dir)
+        profile_store = open_store(os.path.join(profile_dir, 'profiles.sqlite'))
+        try:
+            for name, submit in benchmark_units(session, current_schema, last_schema, cutoff_date, start_date, profile_store).items():
+                (elapsed, queries, rows_scanned, bytes_scanned), unit_results = timed_unit(session, submit, args.max_concurrency, args.repeat)
+                results.update(unit_results)
+                print(f"{name:<26} {elapsed:>9.2f} {queries:>8} {rows_scanned:>14} {bytes_scanned / 1e6:>11.1f}")
+
+            session.reset()
+            started = time.perf_counter()
+            _, errors = run_report(session, current_schema, last_schema, cutoff_date, max_concurrency=args.max_concurrency)
+            elapsed = time.perf_counter() - started
+            print(f"{'full report (concurrent)':<26} {elapsed:>9.2f} {session.queries:>8} {session.rows_scanned:>14} {session.bytes_scanned / 1e6:>11.1f}")
+        finally:
+            session.close()
+
+    mismatches = verify(results, current_manifest, last_manifest)
+    mismatches += [f"report section {section} failed: {error}" for section, error in errors.items()]
+    for mismatch in mismatches:
+        print(f"MISMATCH {mismatch}")
+    print("all checks match the injected errors" if not mismatches else f"{len(mismatches)} mismatches")
+    return not mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the EDC checks on a synthetic CDM")
+    parser.add_argument('--root', default=os.path.join(tempfile.gettempdir(), 'edc_synthetic_cdm'))
+    parser.add_argument('--rows', type=int, nargs='+', default=[100_000, 1_000_000], help="approximate total rows of the current schema")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--end-date', type=date.fromisoformat, default=date.today(), help="last date in the data; also the cutoff date")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--max-concurrency', type=int, default=default_max_concurrency)
+    parser.add_argument('--chunk-rows', type=int, default=default_chunk_rows)
+    parser.add_argument('--regenerate', action='store_true', help="rewrite schemas even when their manifest matches")
+    rate_arguments(parser)
+    args = parser.parse_args()
+
+    os.makedirs(args.root, exist_ok=True)
+    passed = [run_scale(args, rows) for rows in args.rows]
+    return 0 if all(passed) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
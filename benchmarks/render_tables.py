@@ -0,0 +1,89 @@
+# Render time and HTML payload of the check tables at 10^2-10^5 rows.
+#
+#   python benchmarks/render_tables.py [--repeat 3] > bench_output.txt
+#
+# "legacy" is the per-cell getattr / inline-style renderer the app used before html_tables;
+# "columnar" renders the whole result, "paged" only the first page the app would show.
+import argparse
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'edc_check_streamlit_app'))
+
+from html_tables import default_page_size, exceeds, page_bounds, table_html  # noqa: E402
+
+
+def legacy_generic_table(records, red_columns, ignore_colums, bold_columns, red_value):
+    tr = ''
+    for row in records:
+        row_html = '<tr>'
+        for col in row._fields:
+            if col in ignore_colums:
+                continue
+            color = 'black'
+            weight = 'normal'
+            if col in red_columns:
+                if getattr(row, col) is not None:
+                    if (isinstance(getattr(row, col), str) and getattr(row, col) == red_value) or (not isinstance(getattr(row, col), str) and getattr(row, col) > red_value):
+                        color = 'red'
+            if col in bold_columns and getattr(row, col) is not None:
+                weight = 'bold'
+            row_html += f'<td style="border: 1px solid black; padding: 8px; text-align: center; color:{color};font-weight:{weight};">{getattr(row, col)}</td>'
+        row_html += '</tr>'
+        tr += row_html
+    headers = ''.join([f'<th style="border: 1px solid black; padding: 8px; text-align: center; background-color: #4CAF50; color: white;min-width:300px;">{col}</th>' for col in records[0]._fields if col not in ignore_colums])
+    return f'''<table style="width:95%; border-collapse: collapse; border: 1px solid black;margin:25px auto;"><tr>{headers}</tr>{tr}</table>'''
+
+
+def drilldown_rows(row_count, seed=0):
+    # shaped like a drill-down result: a table name, a date, counts and a percentage
+    rng = random.Random(seed)
+    tables = ['DIAGNOSIS', 'PROCEDURES', 'LAB_RESULT_CM', 'PRESCRIBING', 'VITAL']
+    return [{
+        "TABLE": rng.choice(tables),
+        "DATE": f"20{rng.randint(10, 24)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        "Count": rng.randint(0, 100000),
+        "PATIENTS": rng.randint(0, 5000),
+        "PERCENTAGE": round(rng.random() * 10, 2),
+    } for _ in range(row_count)]
+
+
+def timed(render, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        html = render()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, len(html.encode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max-rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'renderer':>9} {'ms':>10} {'bytes':>12}")
+    row_count = 100
+    while row_count <= args.max_rows:
+        rows = drilldown_rows(row_count)
+        Record = namedtuple('Record', rows[0])
+        records = [Record(**row) for row in rows]
+        start, stop = page_bounds(row_count, 0, default_page_size)
+        renderers = [
+            ('legacy', lambda: legacy_generic_table(records, ['PERCENTAGE'], [], ['TABLE'], 4.99)),
+            ('columnar', lambda: table_html(rows, ['PERCENTAGE'], exceeds(4.99), ['TABLE'])),
+            ('paged', lambda: table_html(rows, ['PERCENTAGE'], exceeds(4.99), ['TABLE'], start=start, stop=stop)),
+        ]
+        for name, render in renderers:
+            elapsed_ms, size = timed(render, args.repeat)
+            print(f"{row_count:>8} {name:>9} {elapsed_ms:>10.1f} {size:>12}")
+        row_count *= 10
+
+
+if __name__ == '__main__':
+    main()
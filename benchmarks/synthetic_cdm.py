@@ -0,0 +1,358 @@
+# Seeded synthetic PCORnet CDM for benchmarking the checks. Every table the checks read is
+# written as Parquet under <root>/<SCHEMA>/<TABLE>/part-*.parquet, the layout DuckDBSession reads,
+# by DuckDB itself straight from range() so that 10^9 rows stream to disk chunk by chunk.
+#
+#   python benchmarks/synthetic_cdm.py --root /data/synthetic --schema SYNTH --rows 1000000
+#
+# Errors are injected at exact, known positions: row i of a table belongs to error slot i % 10,
+# and within its slot every period-th row carries the error, with period = 0.1 / rate. Slots never
+# overlap, so the expected result of every check follows from the row counts alone and is written
+# next to the data in manifest.json.
+import argparse
+import json
+import os
+import shutil
+import sys
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'edc_check_streamlit_app'))
+
+from check_registry import (table_dict, primary_key_dict, patid_tables, encounterid_tables, replication_tables,  # noqa: E402
+                            encounter_patient_tables, provider_tables, years_before)
+
+
+# error -> slot (row number % 10); a rate is the fraction of all rows of an affected table
+error_slots = {
+    'orphan_patid': 1,
+    'orphan_encounterid': 2,
+    'replication_mismatch': 3,
+    'multi_patient_encounter': 4,
+    'orphan_providerid': 5,
+    'duplicate_key': 6,
+}
+
+default_rates = {
+    'orphan_patid': 0.001,
+    'orphan_encounterid': 0.002,
+    'replication_mismatch': 0.001,
+    'multi_patient_encounter': 0.0005,
+    'orphan_providerid': 0.001,
+    'duplicate_key': 0.0001,
+}
+
+# share of the requested rows per table; the DEMOGRAPHIC share is also the number of patients
+table_shares = {
+    'DEMOGRAPHIC': 0.02,
+    'ENROLLMENT': 0.02,
+    'ENCOUNTER': 0.08,
+    'DIAGNOSIS': 0.18,
+    'PROCEDURES': 0.1,
+    'VITAL': 0.08,
+    'DEATH': 0.002,
+    'PRESCRIBING': 0.08,
+    'DISPENSING': 0.04,
+    'LAB_RESULT_CM': 0.2,
+    'CONDITION': 0.03,
+    'DEATH_CAUSE': 0.002,
+    'PRO_CM': 0.01,
+    'PROVIDER': 0.001,
+    'MED_ADMIN': 0.05,
+    'OBS_CLIN': 0.04,
+    'OBS_GEN': 0.02,
+    'HASH_TOKEN': 0.02,
+    'IMMUNIZATION': 0.01,
+    'LDS_ADDRESS_HISTORY': 0.02,
+    'PCORNET_TRIAL': 0.001,
+    'LAB_HISTORY': 0.001,
+    'HARVEST': 0,
+}
+
+minimum_table_rows = 20
+
+default_chunk_rows = 50_000_000
+
+enc_types = ['AV', 'ED', 'IP', 'OA', 'TH', 'EI', 'OS']
+
+# primary key column and value prefix of the tables keyed by a single ID
+id_columns = {
+    'DIAGNOSIS': ('DIAGNOSISID', 'DX'), 'PROCEDURES': ('PROCEDURESID', 'PX'), 'VITAL': ('VITALID', 'VT'),
+    'PRESCRIBING': ('PRESCRIBINGID', 'RX'), 'DISPENSING': ('DISPENSINGID', 'DS'), 'LAB_RESULT_CM': ('LAB_RESULT_CM_ID', 'LR'),
+    'CONDITION': ('CONDITIONID', 'CN'), 'PRO_CM': ('PRO_CM_ID', 'PR'), 'MED_ADMIN': ('MEDADMINID', 'MA'),
+    'OBS_CLIN': ('OBSCLINID', 'OC'), 'OBS_GEN': ('OBSGENID', 'OG'), 'IMMUNIZATION': ('IMMUNIZATIONID', 'IM'),
+    'LDS_ADDRESS_HISTORY': ('ADDRESSID', 'AD'), 'LAB_HISTORY': ('LABHISTORYID', 'LH'),
+}
+
+# table -> (code type column, code column, code types, distinct codes per type)
+code_columns = {
+    'DIAGNOSIS': ('DX_TYPE', 'DX', ['09', '10'], 5000),
+    'PROCEDURES': ('PX_TYPE', 'PX', ['09', '10', 'CH', 'ND'], 3000),
+    'DISPENSING': (None, 'NDC', [], 2000),
+    'IMMUNIZATION': ('VX_CODE_TYPE', 'VX_CODE', ['CH', 'CX', 'ND', 'RX'], 200),
+    'MED_ADMIN': ('MEDADMIN_TYPE', 'MEDADMIN_CODE', ['ND', 'RX'], 2000),
+    'PRESCRIBING': (None, 'RXNORM_CUI', [], 2000),
+}
+
+demographic_values = {
+    'SEX': ['F', 'M', 'F', 'M', 'UN'],
+    'HISPANIC': ['N', 'N', 'N', 'Y', 'R', 'NI'],
+    'RACE': ['05', '05', '05', '03', '02', '01', '04', '06', '07', 'NI', 'UN', 'OT'],
+    'GENDER_IDENTITY': ['W', 'M', 'W', 'M', 'GQ', 'TF', 'TM', 'SE', 'MU', 'DC', 'NI', 'UN', 'OT'],
+    'SEXUAL_ORIENTATION': ['ST', 'ST', 'ST', 'BI', 'GA', 'LE', 'QU', 'AS', 'MU', 'SE', 'QS', 'DC', 'NI', 'UN', 'OT'],
+}
+
+
+def injection_period(rate):
+    if rate < 0 or rate > 0.1:
+        raise ValueError(f"Injected error rates must lie between 0 and 0.1, got {rate}")
+    return round(0.1 / rate) if rate else 0
+
+
+def injected_count(row_count, error, rates):
+    # rows i < row_count with i % 10 == slot and (i // 10) % period == 0
+    period = injection_period(rates.get(error, 0))
+    slot = error_slots[error]
+    if not period or row_count <= slot:
+        return 0
+    return ((row_count - slot + 9) // 10 + period - 1) // period
+
+
+class TableShape:
+    # row counts and injection predicates shared by the SQL of every table of one schema
+
+    def __init__(self, rows, rates, seed, start_date, end_date):
+        self.rows = rows
+        self.rates = {**default_rates, **(rates or {})}
+        self.seed = seed
+        self.start_date = start_date
+        self.span_days = (end_date - start_date).days + 1
+        self.table_rows = {table: max(round(rows * share), minimum_table_rows) for table, share in table_shares.items()}
+        self.table_rows['HARVEST'] = 1
+        self.patients = self.table_rows['DEMOGRAPHIC']
+        self.table_rows['DEATH'] = min(self.table_rows['DEATH'], self.patients)
+        self.encounters = self.table_rows['ENCOUNTER']
+        self.providers = self.table_rows['PROVIDER']
+
+    def applies(self, error, table):
+        if error == 'orphan_patid':
+            return table in patid_tables
+        if error in ('orphan_encounterid', 'multi_patient_encounter'):
+            return table in encounterid_tables
+        if error == 'replication_mismatch':
+            return table in replication_tables
+        if error == 'orphan_providerid':
+            return table in provider_tables
+        return table in id_columns
+
+    def injected(self, error, table):
+        return injected_count(self.table_rows[table], error, self.rates) if self.applies(error, table) else 0
+
+    def slot(self, error, table):
+        period = injection_period(self.rates.get(error, 0))
+        if not period or not self.applies(error, table):
+            return 'FALSE'
+        return f"(i % 10 = {error_slots[error]} AND (i // 10) % {period} = 0)"
+
+    def mix(self, expr, salt=0):
+        # a cheap deterministic scramble of a row or key number
+        return f"((({expr}) * 2654435761 + {self.seed * 7919 + salt}) % 4294967291)"
+
+    def date_of(self, expr):
+        return f"(DATE '{self.start_date}' + CAST({self.mix(expr, 17)} % {self.span_days} AS INTEGER))"
+
+    def pick(self, values, expr, salt):
+        return f"([{', '.join(repr(value) for value in values)}])[1 + CAST({self.mix(expr, salt)} % {len(values)} AS INTEGER)]"
+
+    def enc_type(self, expr):
+        return f"([{', '.join(repr(value) for value in enc_types)}])[1 + CAST(({expr} + {self.seed}) % {len(enc_types)} AS INTEGER)]"
+
+    def provider(self, table):
+        return f"CASE WHEN {self.slot('orphan_providerid', table)} THEN 'XV' || i ELSE 'V' || ({self.mix('i', 29)} % {self.providers}) END"
+
+    def patid(self, table, patient):
+        return f"CASE WHEN {self.slot('orphan_patid', table)} THEN 'XP' || i ELSE 'P' || ({patient}) END"
+
+
+def row_source(shape, table, first, last):
+    # i is the row number; k the encounter key the row belongs to (the row itself when the table
+    # is not linked to ENCOUNTER); x = 1 marks the second-patient row of a multi-patient encounter
+    if table not in encounterid_tables:
+        return f"(SELECT range AS i, range AS k, 0 AS x FROM range({first}, {last}))"
+    multi = shape.slot('multi_patient_encounter', table)
+    key = f"CASE WHEN {multi} THEN {shape.encounters} + i ELSE (i * 7919 + {shape.seed}) % {shape.encounters} END"
+    return f"""(SELECT i, {key} AS k, x FROM (
+            SELECT range AS i, 0 AS x FROM range({first}, {last})
+            UNION ALL SELECT i, 1 AS x FROM (SELECT range AS i FROM range({first}, {last})) WHERE {multi}))"""
+
+
+def linked_columns(shape, table):
+    # PATID, ENCOUNTERID and the row ID of a table linked to ENCOUNTER
+    id_column, prefix = id_columns[table]
+    patient = f"CASE WHEN x = 1 THEN (k + 1) % {shape.patients} ELSE k % {shape.patients} END"
+    encounter = (f"CASE WHEN {shape.slot('orphan_patid', table)} THEN NULL "
+                 f"WHEN {shape.slot('orphan_encounterid', table)} THEN 'XE' || i "
+                 f"WHEN {shape.slot('multi_patient_encounter', table)} THEN 'M{prefix}' || i ELSE 'E' || k END")
+    return [
+        (id_column, f"CASE WHEN {shape.slot('duplicate_key', table)} THEN '{prefix}' || (i - 1) WHEN x = 1 THEN '{prefix}X' || i ELSE '{prefix}' || i END"),
+        ('PATID', shape.patid(table, patient)),
+        ('ENCOUNTERID', encounter),
+    ]
+
+
+def table_columns(shape, table):
+    # (column, SQL expression) of every column the checks read
+    date_column = table_dict.get(table)
+    row_date = shape.date_of('k')
+    if table == 'DEMOGRAPHIC':
+        columns = [('PATID', "'P' || i"),
+                   ('BIRTH_DATE', f"CASE WHEN i % 50 = 0 THEN NULL ELSE DATE '1925-01-01' + CAST({shape.mix('i', 3)} % 36500 AS INTEGER) END")]
+        columns += [(column, shape.pick(values, 'i', salt)) for salt, (column, values) in enumerate(demographic_values.items())]
+        return columns
+    if table == 'PROVIDER':
+        return [('PROVIDERID', "'V' || i"), ('PROVIDER_SEX', shape.pick(['F', 'M'], 'i', 5))]
+    if table == 'HARVEST':
+        return [('NETWORKID', "'SYNTHETIC'"), ('DATAMARTID', "'SYNTHETIC_DM'"), ('REFRESH_ENCOUNTER_DATE', f"DATE '{shape.start_date}'")]
+    if table == 'ENCOUNTER':
+        return [('ENCOUNTERID', "'E' || i"), ('PATID', shape.patid(table, f"k % {shape.patients}")),
+                ('ADMIT_DATE', row_date), ('ENC_TYPE', shape.enc_type('k')), ('PROVIDERID', shape.provider(table))]
+
+    patient = f"(i + {shape.seed}) % {shape.patients}"
+    if table in encounterid_tables:
+        columns = linked_columns(shape, table)
+    elif table in id_columns:
+        id_column, prefix = id_columns[table]
+        columns = [(id_column, f"CASE WHEN {shape.slot('duplicate_key', table)} THEN '{prefix}' || (i - 1) ELSE '{prefix}' || i END")]
+        if table != 'LAB_HISTORY':
+            columns.append(('PATID', shape.patid(table, patient)))
+    elif table == 'DEATH':
+        columns = [('PATID', shape.patid(table, 'i')), ('DEATH_SOURCE', "'L'"), ('DEATH_DATE', row_date)]
+    elif table == 'DEATH_CAUSE':
+        columns = [('PATID', shape.patid(table, patient)), ('DEATH_CAUSE', "'C' || i"), ('DEATH_CAUSE_CODE', "'10'"),
+                   ('DEATH_CAUSE_TYPE', "'U'"), ('DEATH_CAUSE_SOURCE', "'L'")]
+    elif table == 'ENROLLMENT':
+        # (PATID, ENR_START_DATE) is unique because i -> (i % patients, i // patients) is
+        columns = [('PATID', shape.patid(table, f"i % {shape.patients}")),
+                   ('ENR_START_DATE', f"DATE '{shape.start_date}' + CAST(i // {shape.patients} AS INTEGER)"), ('ENR_BASIS', "'E'")]
+    elif table == 'HASH_TOKEN':
+        columns = [('PATID', shape.patid(table, patient)), ('TOKEN_ENCRYPTION_KEY', "'K' || i")]
+    elif table == 'PCORNET_TRIAL':
+        columns = [('PATID', shape.patid(table, patient)), ('TRIALID', "'T1'"), ('PARTICIPANTID', "'T' || i")]
+    else:
+        raise ValueError(f"No synthetic columns defined for {table}")
+
+    if date_column:
+        columns.append((date_column, row_date))
+    if table in replication_tables:
+        columns.append(('ENC_TYPE', f"CASE WHEN {shape.slot('replication_mismatch', table)} THEN {shape.enc_type('k + 1')} ELSE {shape.enc_type('k')} END"))
+    if table in provider_tables:
+        columns.append((provider_tables[table], shape.provider(table)))
+    if table in code_columns:
+        type_column, code_column, code_types, code_count = code_columns[table]
+        if type_column:
+            columns.append((type_column, shape.pick(code_types, 'i', 11)))
+        columns.append((code_column, f"'{code_column[:2]}' || ({shape.mix('i', 13)} % {code_count})"))
+    return columns
+
+
+def multi_patient_encounters_sql(shape):
+    # the ENCOUNTER rows of the injected multi-patient encounters, keyed like the child rows
+    branches = []
+    for table in encounterid_tables:
+        multi = shape.slot('multi_patient_encounter', table)
+        if multi == 'FALSE':
+            continue
+        prefix = id_columns[table][1]
+        branches.append(f"""SELECT 'M{prefix}' || i AS ENCOUNTERID, 'P' || (k % {shape.patients}) AS PATID, {shape.date_of('k')} AS ADMIT_DATE,
+                   {shape.enc_type('k')} AS ENC_TYPE, 'V' || ({shape.mix('i', 29)} % {shape.providers}) AS PROVIDERID
+            FROM (SELECT range AS i, {shape.encounters} + range AS k FROM range(0, {shape.table_rows[table]}))
+            WHERE {multi}""")
+    return ' UNION ALL '.join(branches)
+
+
+def table_sql(shape, table, first, last):
+    select = ', '.join(f"{expr} AS {column}" for column, expr in table_columns(shape, table))
+    return f"SELECT {select} FROM {row_source(shape, table, first, last)}"
+
+
+def expected_results(shape):
+    # what every check must report on this schema when all rows fall inside the lookback window
+    multi = {table: shape.injected('multi_patient_encounter', table) for table in encounterid_tables}
+    records = {table: shape.table_rows[table] + multi.get(table, 0) for table in shape.table_rows}
+    records['ENCOUNTER'] += sum(multi.values())
+    return {
+        'records': records,
+        'patients': shape.patients,
+        '1.05': {table: 'Yes' if shape.injected('duplicate_key', table) else 'No' for table in primary_key_dict},
+        '1.08': {table: shape.injected('orphan_patid', table) for table in patid_tables},
+        '1.09': {table: shape.injected('orphan_encounterid', table) for table in encounterid_tables},
+        '1.10': {table: shape.injected('replication_mismatch', table) for table in replication_tables},
+        '1.11': {table: multi.get(table, 0) for table in encounter_patient_tables},
+        '1.12': {table: shape.injected('orphan_providerid', table) for table in provider_tables},
+    }
+
+
+def generate_cdm(root, schema, rows, rates=None, seed=0, start_date=None, end_date=None, chunk_rows=default_chunk_rows, connection=None):
+    # writes every table of one synthetic schema and returns its manifest
+    import duckdb
+    end_date = end_date or date.today()
+    start_date = start_date or years_before(end_date, 9)
+    shape = TableShape(rows, rates, seed, start_date, end_date)
+    connection = connection or duckdb.connect()
+    directory = os.path.join(root, schema.upper())
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    for table, row_count in shape.table_rows.items():
+        table_directory = os.path.join(directory, table)
+        os.makedirs(table_directory)
+        for part, first in enumerate(range(0, row_count, chunk_rows)):
+            last = min(first + chunk_rows, row_count)
+            path = os.path.join(table_directory, f"part-{part:05d}.parquet")
+            connection.execute(f"COPY ({table_sql(shape, table, first, last)}) TO '{path}' (FORMAT PARQUET)")
+    extra = multi_patient_encounters_sql(shape)
+    if extra:
+        connection.execute(f"COPY ({extra}) TO '{os.path.join(directory, 'ENCOUNTER', 'multi-patient.parquet')}' (FORMAT PARQUET)")
+
+    manifest = {
+        'schema': schema.upper(), 'rows': rows, 'seed': seed, 'rates': shape.rates,
+        'start_date': str(start_date), 'end_date': str(end_date),
+        'patients': shape.patients, 'encounters': shape.encounters, 'providers': shape.providers,
+        'expected': expected_results(shape),
+    }
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def read_manifest(root, schema):
+    path = os.path.join(root, schema.upper(), 'manifest.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def rate_arguments(parser):
+    for error, rate in default_rates.items():
+        parser.add_argument(f"--{error.replace('_', '-')}-rate", type=float, default=rate, dest=error)
+
+
+def parsed_rates(args):
+    return {error: getattr(args, error) for error in default_rates}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a seeded synthetic PCORnet CDM as Parquet")
+    parser.add_argument('--root', required=True)
+    parser.add_argument('--schema', default='SYNTHETIC_CDM')
+    parser.add_argument('--rows', type=int, default=100_000, help="approximate total rows over all tables")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--end-date', type=date.fromisoformat, default=date.today())
+    parser.add_argument('--chunk-rows', type=int, default=default_chunk_rows)
+    rate_arguments(parser)
+    args = parser.parse_args()
+    manifest = generate_cdm(args.root, args.schema, args.rows, parsed_rates(args), args.seed,
+                            end_date=args.end_date, chunk_rows=args.chunk_rows)
+    print(json.dumps({table: count for table, count in manifest['expected']['records'].items()}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
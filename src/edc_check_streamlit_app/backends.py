@@ -0,0 +1,240 @@
+# Query backends. The checks only ever call session.sql(text).collect() / .collect_nowait() and
+# read rows through as_dict(), so any object offering that subset can stand in for a Snowpark
+# session. DuckDBSession runs the same checks against local Parquet extracts of the CDM laid out
+# as <root>/<SCHEMA>/<TABLE>.parquet (or <root>/<SCHEMA>/<TABLE>/*.parquet), translating the
+# Snowflake-specific SQL on the way.
+import os
+import re
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+
+# (pattern, replacement) applied in order to every statement sent to DuckDB
+duckdb_translations = [
+    # the catalog of the extracts, with ROW_COUNT from the Parquet footers and times from the files
+    (re.compile(r"\bINFORMATION_SCHEMA\.TABLES\b", re.I), "EDC_CATALOG.TABLES"),
+    (re.compile(r"\bINFORMATION_SCHEMA\.SCHEMATA\b", re.I), "EDC_CATALOG.SCHEMATA"),
+    (re.compile(r"\bLISTAGG\s*\(", re.I), "STRING_AGG("),
+    (re.compile(r"\bBITOR_AGG\s*\(", re.I), "BIT_OR("),
+    (re.compile(r"\bDATEDIFF\s*\(\s*(YEAR|MONTH|DAY)\s*,", re.I), lambda match: f"DATE_DIFF('{match.group(1).lower()}',"),
+    (re.compile(r"::\s*FLOAT\b", re.I), "::DOUBLE"),
+    (re.compile(r"\bTO_VARCHAR\s*\(", re.I), "EDC_TO_VARCHAR("),
+    # DuckDB's COUNT_IF is NULL when no condition is true or known; Snowflake's is 0
+    (re.compile(r"\bCOUNT_IF\s*\(", re.I), "EDC_COUNT_IF("),
+    # temporary tables belong to one connection, but every statement runs on its own cursor
+    (re.compile(r"\bCREATE\s+OR\s+REPLACE\s+TEMPORARY\s+TABLE\b", re.I), "CREATE OR REPLACE TABLE"),
+]
+
+to_char_pattern = re.compile(r"\bTO_CHAR\s*\(([^,()]+),\s*'([^']*)'\s*\)", re.I)
+
+# Snowflake date format elements -> strftime
+to_char_formats = [('YYYY', '%Y'), ('MM', '%m'), ('DD', '%d'), ('HH24', '%H'), ('MI', '%M'), ('SS', '%S')]
+
+
+def translate_to_char(match):
+    fmt = match.group(2)
+    for element, directive in to_char_formats:
+        fmt = fmt.replace(element, directive)
+    return f"STRFTIME({match.group(1)}, '{fmt}')"
+
+
+def translate_sql(sql):
+    sql = to_char_pattern.sub(translate_to_char, sql)
+    for pattern, replacement in duckdb_translations:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+
+# DuckDB column type -> the Snowpark DataType it stands in for
+snowpark_type_names = {
+    'VARCHAR': 'StringType', 'BIGINT': 'LongType', 'INTEGER': 'LongType', 'SMALLINT': 'LongType', 'TINYINT': 'LongType',
+    'HUGEINT': 'LongType', 'UBIGINT': 'LongType', 'UINTEGER': 'LongType', 'DOUBLE': 'DoubleType', 'FLOAT': 'DoubleType',
+    'DATE': 'DateType', 'TIMESTAMP': 'TimestampType', 'BOOLEAN': 'BooleanType',
+}
+
+DuckDBField = namedtuple('DuckDBField', ['name', 'datatype'])
+DuckDBSchema = namedtuple('DuckDBSchema', ['fields'])
+
+# type_name as Snowpark names its DataType classes; precision and scale only for DecimalType
+DuckDBDataType = namedtuple('DuckDBDataType', ['type_name', 'precision', 'scale'], defaults=(None, None))
+
+
+def duckdb_data_type(column_type):
+    decimal = re.match(r"DECIMAL\((\d+),\s*(\d+)\)", column_type)
+    if decimal:
+        return DuckDBDataType('DecimalType', int(decimal.group(1)), int(decimal.group(2)))
+    return DuckDBDataType(snowpark_type_names.get(column_type, 'StringType'))
+
+
+def result_names(translated, names):
+    # Snowflake upper-cases unquoted identifiers; quoted ones keep their case
+    quoted = set(re.findall(r'"([^"]+)"', translated))
+    return [name if name in quoted else name.upper() for name in names]
+
+
+class DuckDBRow(dict):
+
+    def as_dict(self):
+        return dict(self)
+
+
+class DuckDBJob:
+    # collect_nowait() leaves the statement to result(), which runs it on the caller's thread,
+    # already a worker of the check executor, so the checks stay concurrent. DuckDB has no query
+    # ids, so query_id is always None.
+    query_id = None
+
+    def __init__(self, statement, statement_params):
+        self._statement = statement
+        self._statement_params = statement_params
+
+    def result(self, result_type='row'):
+        if result_type == 'row_iterator':
+            return self._statement.to_local_iterator(self._statement_params)
+        return self._statement.collect_within_timeout(self._statement_params)
+
+
+class DuckDBStatement:
+
+    def __init__(self, session, sql):
+        self._session = session
+        self._sql = sql
+
+    def _execute(self, cursor):
+        # column names of the result as Snowflake would report them
+        translated = translate_sql(self._sql)
+        cursor.execute(translated)
+        if cursor.description is None:
+            return None
+        return result_names(translated, [name for name, *_ in cursor.description])
+
+    @property
+    def schema(self):
+        # the result columns as DataFrame.schema reports them, without running the statement
+        translated = translate_sql(self._sql)
+        cursor = self._session.cursor()
+        try:
+            columns = cursor.execute(f"DESCRIBE {translated}").fetchall()
+        finally:
+            cursor.close()
+        names = result_names(translated, [column[0] for column in columns])
+        return DuckDBSchema([DuckDBField(name, duckdb_data_type(column[1])) for name, column in zip(names, columns)])
+
+    def collect(self):
+        cursor = self._cursor = self._session.cursor()
+        try:
+            names = self._execute(cursor)
+            if names is None:
+                return []
+            return [DuckDBRow(zip(names, values)) for values in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def to_local_iterator(self, statement_params=None, batch_size=10000):
+        cursor = self._session.cursor()
+        try:
+            names = self._execute(cursor)
+            while names is not None:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                for values in batch:
+                    yield DuckDBRow(zip(names, values))
+        finally:
+            cursor.close()
+
+    def collect_nowait(self, statement_params=None):
+        return DuckDBJob(self, statement_params)
+
+    def collect_within_timeout(self, statement_params=None):
+        # QUERY_TAG has no DuckDB equivalent; STATEMENT_TIMEOUT_IN_SECONDS interrupts the
+        # statement and fails it with TimeoutError
+        import duckdb
+        timeout = (statement_params or {}).get('STATEMENT_TIMEOUT_IN_SECONDS')
+        if not timeout:
+            return self.collect()
+        timer = threading.Timer(timeout, self._interrupt)
+        timer.start()
+        try:
+            return self.collect()
+        except duckdb.InterruptException as error:
+            raise TimeoutError(f"Statement reached its statement timeout of {timeout} second(s)") from error
+        finally:
+            timer.cancel()
+
+    def _interrupt(self):
+        cursor = getattr(self, '_cursor', None)
+        try:
+            if cursor is not None:
+                cursor.interrupt()
+        except Exception:
+            pass  # the statement finished and closed its cursor
+
+
+class DuckDBSession:
+
+    def __init__(self, root, database=':memory:'):
+        import duckdb
+        self.root = root
+        self._connection = duckdb.connect(database)
+        self._lock = threading.Lock()
+        self._connection.execute("CREATE OR REPLACE MACRO EDC_TO_VARCHAR(value) AS CAST(value AS VARCHAR)")
+        self._connection.execute("CREATE OR REPLACE MACRO EDC_COUNT_IF(condition) AS COALESCE(COUNT_IF(condition), 0)")
+        self._connection.execute("CREATE SCHEMA IF NOT EXISTS EDC_CATALOG")
+        self._connection.execute("""CREATE OR REPLACE TABLE EDC_CATALOG.TABLES (
+                                        TABLE_SCHEMA VARCHAR, TABLE_NAME VARCHAR, TABLE_TYPE VARCHAR,
+                                        ROW_COUNT BIGINT, LAST_ALTERED TIMESTAMP)""")
+        self._connection.execute("CREATE OR REPLACE TABLE EDC_CATALOG.SCHEMATA (SCHEMA_NAME VARCHAR, CREATED TIMESTAMP)")
+        for schema in sorted(os.listdir(root)):
+            if os.path.isdir(os.path.join(root, schema)):
+                self.attach_schema(schema)
+
+    def attach_schema(self, schema):
+        directory = os.path.join(self.root, schema)
+        self._connection.execute(f'CREATE SCHEMA IF NOT EXISTS "{schema.upper()}"')
+        for entry in sorted(os.listdir(directory)):
+            path = os.path.join(directory, entry)
+            if entry.endswith('.parquet'):
+                table, files = entry[:-len('.parquet')], [path]
+            elif os.path.isdir(path):
+                table, files = entry, [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.parquet')]
+            else:
+                continue
+            if not files:
+                continue
+            table = table.upper()
+            file_list = ", ".join(f"'{file}'" for file in files)
+            self._connection.execute(f'CREATE OR REPLACE VIEW "{schema.upper()}"."{table}" AS SELECT * FROM read_parquet([{file_list}])')
+            row_count = self._connection.execute(f"SELECT SUM(num_rows) FROM parquet_file_metadata([{file_list}])").fetchone()[0]
+            last_altered = datetime.fromtimestamp(max(os.path.getmtime(file) for file in files))
+            self._connection.execute("INSERT INTO EDC_CATALOG.TABLES VALUES (?, ?, 'BASE TABLE', ?, ?)",
+                                     [schema.upper(), table, row_count, last_altered])
+        # a refresh counts as created when its oldest extract was written
+        self._connection.execute("""INSERT INTO EDC_CATALOG.SCHEMATA SELECT ?, MIN(LAST_ALTERED) FROM EDC_CATALOG.TABLES
+                                    WHERE TABLE_SCHEMA = ?""", [schema.upper(), schema.upper()])
+
+    def cursor(self):
+        with self._lock:
+            return self._connection.cursor()
+
+    def sql(self, sql):
+        return DuckDBStatement(self, sql)
+
+    def close(self):
+        self._connection.close()
+
+
+def connect_duckdb(root):
+    return DuckDBSession(root)
+
+
+def create_session(connection_name=None, warehouse=None):
+    # a Snowpark session of a named connection (connections.toml), on warehouse if given
+    from snowflake.snowpark import Session
+    builder = Session.builder
+    if connection_name:
+        builder = builder.config('connection_name', connection_name)
+    if warehouse:
+        builder = builder.config('warehouse', warehouse)
+    return builder.create()
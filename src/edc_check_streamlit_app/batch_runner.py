@@ -0,0 +1,251 @@
+# Headless EDC reports for many datamarts. Every (current, previous) schema pair runs the full
+# report on a worker thread with a session borrowed from a small pool, and the results are
+# written as JSON, Parquet (when pandas/pyarrow are installed) and standalone HTML, next to a
+# profile.csv of the statements each report sent and, on request, the rows behind every flagged
+# check:
+#
+#   python batch_runner.py --pairs CDM_2025Q1:CDM_2024Q4 CDM_B_2025Q1:CDM_B_2024Q4 --output-dir reports
+#   python batch_runner.py --all-schemas --workers 4 --connection-name edc
+#   python batch_runner.py --all-schemas --duckdb-root /data/cdm_extracts
+#   python batch_runner.py --all-schemas --heavy-warehouse EDC_WH_L --cost-history edc_reports/*/profile.csv --dry-run
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime
+
+from backends import connect_duckdb, create_session
+from check_scheduler import CostModel, create_routed_session, default_heavy_seconds, read_history, plan_summary
+from metadata_catalog import schema_created
+from query_executor import default_max_concurrency
+from query_profiler import query_log, load_warehouse_stats, profile_rows, profile_csv
+from check_registry import years_before
+from drilldown import flagged_tables, export_exceptions
+from refresh_profile import refresh_series, refresh_order
+from report import report_sections, run_report, plan_report, section_tables, report_html
+from result_store import open_store, _json_default
+
+
+class SessionPool:
+    # sessions are created on first demand, at most `size` of them, and reused by later reports
+
+    def __init__(self, create, size):
+        self._create = create
+        self._size = size
+        self._idle = queue.LifoQueue()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def session(self):
+        session = None
+        try:
+            session = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if len(self._sessions) < self._size:
+                    session = self._create()
+                    self._sessions.append(session)
+        if session is None:
+            session = self._idle.get()
+        try:
+            yield session
+        finally:
+            self._idle.put(session)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+
+
+def consecutive_pairs(schemas, created=None):
+    # every schema against the refresh of the same datamart loaded just before it
+    pairs = []
+    for series in sorted({refresh_series(schema) for schema in schemas}):
+        ordered = refresh_order([schema for schema in schemas if refresh_series(schema) == series], created)
+        pairs += zip(ordered[1:], ordered[:-1])
+    return pairs
+
+
+def parse_pair(text):
+    current_schema, separator, last_schema = text.partition(':')
+    if not separator or not current_schema or not last_schema:
+        raise argparse.ArgumentTypeError(f"expected CURRENT:PREVIOUS, got '{text}'")
+    return current_schema, last_schema
+
+
+def write_parquet(directory, results):
+    try:
+        import pandas as pd
+        import pyarrow  # noqa: F401
+    except ImportError:
+        print("pandas/pyarrow not installed: skipping Parquet output", file=sys.stderr)
+        return
+    for section, result in results.items():
+        frames = []
+        for caption, rows in section_tables(section, result):
+            frame = pd.DataFrame(rows)
+            if caption:
+                # VB: the first column is named after the encounter type
+                frame = frame.rename(columns={caption: 'TABLE_NAME'})
+                frame.insert(0, 'ENC_TYPE', caption)
+            frames.append(frame)
+        pd.concat(frames, ignore_index=True).to_parquet(os.path.join(directory, f"{section}.parquet"), index=False)
+
+
+def write_report(output_dir, formats, current_schema, last_schema, cutoff_date, results, errors, elapsed_seconds):
+    directory = os.path.join(output_dir, current_schema)
+    os.makedirs(directory, exist_ok=True)
+    # one JSON round trip turns Decimals and dates into plain values for every format
+    results = json.loads(json.dumps(results, default=_json_default))
+    if 'json' in formats:
+        with open(os.path.join(directory, 'report.json'), 'w') as handle:
+            json.dump({
+                'current_schema': current_schema,
+                'previous_schema': last_schema,
+                'cutoff_date': str(cutoff_date),
+                'generated_at': datetime.now().isoformat(timespec='seconds'),
+                'elapsed_seconds': round(elapsed_seconds, 1),
+                'results': results,
+                'errors': errors,
+            }, handle, indent=1)
+    if 'parquet' in formats:
+        write_parquet(directory, results)
+    if 'html' in formats:
+        with open(os.path.join(directory, 'report.html'), 'w', encoding='utf-8') as handle:
+            handle.write(report_html(current_schema, last_schema, cutoff_date, results, errors))
+
+
+# report section -> check id of its drill-down
+exception_sections = {'IIA': '1.05', '1.08': '1.08', '1.09': '1.09', '1.10': '1.10', '1.11': '1.11', '1.12': '1.12', 'VA': '4.01'}
+
+
+def write_profile(output_dir, session, current_schema, log_position):
+    # the statements of this pair with their warehouse-side stats, for charge-back per datamart;
+    # the pooled session's log also holds earlier pairs, so only entries from log_position on
+    try:
+        load_warehouse_stats(session)
+    except Exception as error:
+        print(f"{current_schema}: QUERY_HISTORY is not available: {error}", file=sys.stderr)
+    rows = profile_rows(session, log_position)
+    with open(os.path.join(output_dir, current_schema, 'profile.csv'), 'w', newline='') as handle:
+        handle.write(profile_csv(rows))
+
+
+def write_exceptions(output_dir, export_format, session, current_schema, last_schema, cutoff_date, results):
+    # every exception row of every flagged check, one file per (check, table), streamed to disk
+    directory = os.path.join(output_dir, current_schema, 'exceptions')
+    os.makedirs(directory, exist_ok=True)
+    lookback = years_before(cutoff_date, 10)
+    for section, check_id in exception_sections.items():
+        for table in flagged_tables(check_id, results.get(section, [])):
+            path = os.path.join(directory, f"{check_id}_{table}.{export_format}")
+            try:
+                export_exceptions(session, check_id, current_schema, table, path, lookback, last_schema)
+            except Exception as error:
+                print(f"{current_schema}: exceptions of {check_id} {table} not exported: {error}", file=sys.stderr)
+
+
+def cost_model(session, args, history):
+    # profiled statements of earlier pairs on this session refine the estimates as the batch runs
+    heavy_seconds = args.heavy_seconds if args.heavy_warehouse else None
+    return CostModel(session, history + profile_rows(session), heavy_seconds=heavy_seconds)
+
+
+def print_plan(current_schema, last_schema, rows, max_concurrency):
+    summary = plan_summary(rows, max_concurrency)
+    print(f"{current_schema} vs {last_schema}: {summary['calls']} calls, estimated {summary['estimated_seconds']} s "
+          f"(lower bound {summary['lower_bound_seconds']} s, {summary['total_seconds']} s of work)")
+    print(f"  {'#':>3} {'check':<28} {'warehouse':<9} {'est. s':>8} {'slot':>4} {'start':>8}  tables")
+    for row in rows:
+        print(f"  {row['ORDER']:>3} {row['CHECK_ID'] or '-':<28} {row['WAREHOUSE']:<9} {row['ESTIMATED_SECONDS']:>8} "
+              f"{row['SLOT']:>4} {row['START']:>8}  {row['SCHEMA']}.{row['TABLES']}")
+
+
+def plan_pair(pool, store, args, history, current_schema, last_schema):
+    with pool.session() as session:
+        rows = plan_report(session, current_schema, last_schema, args.cutoff_date, store, args.approximate,
+                           args.max_concurrency, cost_model(session, args, history), args.profiles)
+    return {'current_schema': current_schema, 'previous_schema': last_schema, 'plan': rows, 'errors': {}}
+
+
+def run_pair(pool, store, args, history, current_schema, last_schema):
+    started = time.perf_counter()
+    with pool.session() as session:
+        log_position = query_log(session).position()
+        results, errors = run_report(session, current_schema, last_schema, args.cutoff_date, store, args.approximate,
+                                     args.max_concurrency, cost_model(session, args, history), args.profiles)
+        elapsed_seconds = time.perf_counter() - started
+        write_report(args.output_dir, args.formats, current_schema, last_schema, args.cutoff_date, results, errors, elapsed_seconds)
+        if args.export_exceptions:
+            write_exceptions(args.output_dir, args.export_exceptions, session, current_schema, last_schema, args.cutoff_date, results)
+        write_profile(args.output_dir, session, current_schema, log_position)
+    print(f"{current_schema} vs {last_schema}: {len(results)}/{len(report_sections)} sections in {elapsed_seconds:.1f} s"
+          + (f", failed: {', '.join(errors)}" if errors else ''), file=sys.stderr)
+    return {'current_schema': current_schema, 'previous_schema': last_schema, 'elapsed_seconds': round(elapsed_seconds, 1), 'errors': errors}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the EDC report for many CDM schema pairs.")
+    pairs = parser.add_mutually_exclusive_group(required=True)
+    pairs.add_argument('--pairs', nargs='+', type=parse_pair, metavar='CURRENT:PREVIOUS')
+    pairs.add_argument('--all-schemas', action='store_true', help="compare every CDM%% schema with the refresh of its datamart created before it")
+    parser.add_argument('--schema-pattern', default='CDM%')
+    parser.add_argument('--cutoff-date', type=date.fromisoformat, default=date.today(), help="as picked in the app; the checks look back 10 years from it")
+    parser.add_argument('--output-dir', default='edc_reports')
+    parser.add_argument('--formats', nargs='+', choices=['json', 'parquet', 'html'], default=['json', 'parquet', 'html'])
+    parser.add_argument('--workers', type=int, default=4, help="schema pairs reported at the same time (and sessions in the pool)")
+    parser.add_argument('--max-concurrency', type=int, default=default_max_concurrency, help="concurrent statements per report")
+    parser.add_argument('--connection-name', help="connection from the Snowflake connections.toml")
+    parser.add_argument('--duckdb-root', help="run against Parquet extracts in DIR/<SCHEMA>/<TABLE>.parquet with DuckDB instead of Snowflake")
+    parser.add_argument('--approximate', action='store_true', help="estimate distinct patients in Table VA from stored HLL sketches; ignored with --no-store")
+    parser.add_argument('--profiles', action='store_true', help="compute Tables VA-VC from stored refresh profiles; each schema is profiled once")
+    parser.add_argument('--export-exceptions', choices=['csv', 'parquet'], help="also write the rows behind every flagged check to <output-dir>/<schema>/exceptions")
+    parser.add_argument('--no-store', action='store_true', help="do not reuse or save check results")
+    parser.add_argument('--light-warehouse', help="warehouse for most checks (default: the connection's)")
+    parser.add_argument('--heavy-warehouse', help="larger warehouse for the checks estimated above --heavy-seconds")
+    parser.add_argument('--heavy-seconds', type=float, default=default_heavy_seconds, help="estimated seconds above which a check is heavy")
+    parser.add_argument('--cost-history', nargs='+', default=[], metavar='PROFILE_CSV', help="profile.csv files of earlier runs to estimate checks from")
+    parser.add_argument('--dry-run', action='store_true', help="print the planned order, slots and warehouses of every check without running them")
+    args = parser.parse_args(argv)
+
+    if args.duckdb_root:
+        pool = SessionPool(lambda: connect_duckdb(args.duckdb_root), args.workers)
+    elif args.heavy_warehouse:
+        pool = SessionPool(lambda: create_routed_session(args.connection_name, args.light_warehouse, args.heavy_warehouse), args.workers)
+    else:
+        pool = SessionPool(lambda: create_session(args.connection_name, args.light_warehouse), args.workers)
+    store = None if args.no_store else open_store()
+    history = read_history(args.cost_history)
+    try:
+        if args.all_schemas:
+            with pool.session() as session:
+                created = schema_created(session, args.schema_pattern)
+                schema_pairs = consecutive_pairs(list(created), created)
+        else:
+            schema_pairs = args.pairs
+        if args.dry_run:
+            summary = [plan_pair(pool, store, args, history, *pair) for pair in schema_pairs]
+            for entry in summary:
+                print_plan(entry['current_schema'], entry['previous_schema'], entry['plan'], args.max_concurrency)
+        else:
+            with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='edc-report') as executor:
+                summary = list(executor.map(lambda pair: run_pair(pool, store, args, history, *pair), schema_pairs))
+    finally:
+        pool.close()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, 'plan.json' if args.dry_run else 'summary.json'), 'w') as handle:
+        json.dump(summary, handle, indent=1)
+    return 1 if any(entry['errors'] for entry in summary) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
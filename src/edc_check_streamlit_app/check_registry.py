@@ -0,0 +1,211 @@
+# Declarative definitions of the EDC checks. Every check lists the aggregates it needs
+# as Metric entries so the query planner can share one pass per CDM table between them.
+from datetime import date
+from decimal import Decimal, ROUND_HALF_UP
+
+from query_planner import Metric
+
+
+# date column used for cutoff filters and trends, '' when the table is not dated
+table_dict = {
+        'DEMOGRAPHIC': '',
+        'ENROLLMENT': 'ENR_END_DATE',
+        'ENCOUNTER': 'ADMIT_DATE',
+        'DIAGNOSIS': 'ADMIT_DATE',
+        'PROCEDURES': 'ADMIT_DATE',
+        'VITAL': 'MEASURE_DATE',
+        'DEATH': '',
+        'PRESCRIBING': 'RX_ORDER_DATE',
+        'DISPENSING': 'DISPENSE_DATE',
+        'LAB_RESULT_CM': 'RESULT_DATE',
+        'CONDITION': 'REPORT_DATE',
+        'DEATH_CAUSE': '',
+        'PRO_CM': 'PRO_DATE',
+        'PROVIDER': '',
+        'MED_ADMIN': 'MEDADMIN_START_DATE',
+        'OBS_CLIN': 'OBSCLIN_START_DATE',
+        'OBS_GEN': 'OBSGEN_START_DATE',
+        'HASH_TOKEN': '',
+        'IMMUNIZATION': 'VX_ADMIN_DATE',
+        'LDS_ADDRESS_HISTORY': '',
+        # 'LAB_HISTORY': 'PERIOD_START'
+    }
+
+enc_dict = {
+    'AV' : 'Ambulatory_Visit',
+    'ED' : 'Emergency_Department',
+    'IP' : 'Inpatient',
+    'OA' : 'Other_Ambulatory',
+    'TH' : 'Telehealth_Encounters'
+}
+
+# 4.01-4.03: changes below this percentage are exceptions
+decrease_threshold = -5
+
+# 1.05: table -> (primary key expression, CDM specification)
+primary_key_dict = {
+    "DEMOGRAPHIC": ("PATID", "PATID is unique"),
+    "ENROLLMENT": ("PATID || ENR_START_DATE || ENR_BASIS", "ENROLLID (concatenation of PATID + ENR_START_DATE + ENR_BASIS) is unique"),
+    "DEATH": ("PATID || DEATH_SOURCE", "DEATHID (concatenation of PATID and DEATH_SOURCE) is unique"),
+    "ENCOUNTER": ("ENCOUNTERID", "ENCOUNTERID is unique"),
+    "DIAGNOSIS": ("DIAGNOSISID", "DIAGNOSISID is unique"),
+    "PROCEDURES": ("PROCEDURESID", "PROCEDURESID is unique"),
+    "VITAL": ("VITALID", "VITALID is unique"),
+    "PRESCRIBING": ("PRESCRIBINGID", "PRESCRIBINGID is unique"),
+    "DISPENSING": ("DISPENSINGID", "DISPENSINGID is unique"),
+    "LAB_RESULT_CM": ("LAB_RESULT_CM_ID", "LAB_RESULT_CM_ID is unique"),
+    "HARVEST": ("NETWORKID || DATAMARTID", "NETWORKID + DATAMARTID is unique"),
+    "CONDITION": ("CONDITIONID", "CONDITIONID is unique"),
+    "DEATH_CAUSE": ("PATID || DEATH_CAUSE || DEATH_CAUSE_CODE || DEATH_CAUSE_TYPE || DEATH_CAUSE_SOURCE", "DEATHCID (concatenation of PATID + DEATH_CAUSE + DEATH_CAUSE_CODE + DEATH_CAUSE_TYPE + DEATH_CAUSE_SOURCE) is unique"),
+    "PCORNET_TRIAL": ("PATID || TRIALID || PARTICIPANTID", "TRIAL_KEY (concatenation of PATID + TRIALID + PARTICIPANTID) is unique"),
+    "PRO_CM": ("PRO_CM_ID", "PRO_CM_ID is unique"),
+    "PROVIDER": ("PROVIDERID", "PROVIDERID is unique"),
+    "MED_ADMIN": ("MEDADMINID", "MEDADMINID is unique"),
+    "OBS_CLIN": ("OBSCLINID", "OBSCLINID is unique"),
+    "OBS_GEN": ("OBSGENID", "OBSGENID is unique"),
+    "HASH_TOKEN": ("PATID || TOKEN_ENCRYPTION_KEY", "HASHID (concatenation of PATID + TOKEN_ENCRYPTION_KEY) is unique"),
+    "LDS_ADDRESS_HISTORY": ("ADDRESSID", "ADDRESSID is unique"),
+    "IMMUNIZATION": ("IMMUNIZATIONID", "IMMUNIZATIONID is unique"),
+    "LAB_HISTORY": ("LABHISTORYID", "LABHISTORYID is unique")
+}
+
+# 1.08
+patid_tables = [
+    "CONDITION", "DIAGNOSIS", "DEATH", "DEATH_CAUSE", "DISPENSING",
+    "ENCOUNTER", "ENROLLMENT", "HASH_TOKEN", "IMMUNIZATION",
+    "LAB_RESULT_CM", "LDS_ADDRESS_HISTORY", "MED_ADMIN", "OBS_CLIN",
+    "OBS_GEN", "PCORNET_TRIAL", "PRESCRIBING", "PROCEDURES",
+    "PRO_CM",
+    "VITAL"
+]
+
+# 1.09
+encounterid_tables = [
+    "CONDITION", "DIAGNOSIS", "IMMUNIZATION", "LAB_RESULT_CM", "MED_ADMIN",
+    "OBS_CLIN", "OBS_GEN", "PRESCRIBING", "PROCEDURES", "PRO_CM", "VITAL"
+]
+
+# 1.10
+replication_tables = ['DIAGNOSIS', 'PROCEDURES']
+
+# 1.11
+encounter_patient_tables = [
+    "CONDITION", "DIAGNOSIS", "ENCOUNTER", "IMMUNIZATION", "LAB_RESULT_CM", "MED_ADMIN",
+    "OBS_CLIN", "OBS_GEN", "PRESCRIBING", "PROCEDURES", "PRO_CM", "VITAL"
+]
+
+# 1.12: table -> provider column
+provider_tables = {
+    "DIAGNOSIS": "PROVIDERID",
+    "ENCOUNTER": "PROVIDERID",
+    "IMMUNIZATION": "VX_PROVIDERID",
+    "MED_ADMIN": "MEDADMIN_PROVIDERID",
+    "OBS_CLIN": "OBSCLIN_PROVIDERID",
+    "OBS_GEN": "OBSGEN_PROVIDERID",
+    "PRESCRIBING": "RX_PROVIDERID",
+    "PROCEDURES": "PROVIDERID"
+}
+
+# 4.02: tables reported by encounter type, True when ENC_TYPE has to come from ENCOUNTER
+encounter_type_tables = {
+    'DIAGNOSIS': False,
+    'PROCEDURES': False,
+    'LAB_RESULT_CM': True,
+    'PRESCRIBING': True,
+}
+
+# 4.03: table -> (date column, code type column, code column, code types reported)
+# a quoted literal stands in for the type column of tables holding a single code type
+code_type_dict = {
+    'DIAGNOSIS': ('ADMIT_DATE', 'DX_TYPE', 'DX', ['09', '10']),
+    'PROCEDURES': ('ADMIT_DATE', 'PX_TYPE', 'PX', ['09', '10', 'CH', 'ND']),
+    'DISPENSING': ('DISPENSE_DATE', "'ND'", 'NDC', ['ND']),
+    'IMMUNIZATION': ('VX_ADMIN_DATE', 'VX_CODE_TYPE', 'VX_CODE', ['CH', 'CX', 'ND', 'RX']),
+    'MED_ADMIN': ('MEDADMIN_START_DATE', 'MEDADMIN_TYPE', 'MEDADMIN_CODE', ['ND', 'RX']),
+    'PRESCRIBING': ('RX_ORDER_DATE', "'RX'", 'RXNORM_CUI', ['RX']),
+}
+
+
+def years_before(day: date, number_of_years: int) -> date:
+    try:
+        return day.replace(year=day.year - number_of_years)
+    except ValueError:            # handles Feb 29 ↦ Feb 28
+        return day.replace(month=2, day=28, year=day.year - number_of_years)
+
+
+def years_ago(number_of_years: int) -> str:
+    return years_before(date.today(), number_of_years).strftime("%Y-%m-%d")
+
+
+def cutoff_filter(table, cutoff_date):
+    col = table_dict.get(table, '')
+    if col == '' or cutoff_date is None:
+        return ''
+    return f"{col} >= '{cutoff_date}'"
+
+
+def primary_key_metrics(schema):
+    metrics = []
+    for table, (key, _) in primary_key_dict.items():
+        metrics.append(Metric(('1.05', 'keys', table), schema, table, 'count_distinct', key, ''))
+        metrics.append(Metric(('1.05', 'rows', table), schema, table, 'count', '', ''))
+    return metrics
+
+
+def orphan_metrics(schema):
+    # numerator and denominator of 1.08, 1.09 and 1.12 come out of the same pass over the child table
+    metrics = []
+    for table in patid_tables:
+        metrics.append(Metric(('1.08', 'total', table), schema, table, 'count_distinct', 'PATID', ''))
+        metrics.append(Metric(('1.08', 'orphans', table), schema, table, 'count_distinct', 'PATID', '', 'PATID'))
+    for table in encounterid_tables:
+        metrics.append(Metric(('1.09', 'total', table), schema, table, 'count_distinct', 'ENCOUNTERID', ''))
+        metrics.append(Metric(('1.09', 'orphans', table), schema, table, 'count_distinct', 'ENCOUNTERID', '', 'ENCOUNTERID'))
+    for table, provider_id in provider_tables.items():
+        metrics.append(Metric(('1.12', 'total', table), schema, table, 'count_distinct', provider_id, ''))
+        metrics.append(Metric(('1.12', 'orphans', table), schema, table, 'count_distinct', provider_id, '', 'PROVIDERID'))
+    return metrics
+
+
+def table_change_metrics(schema, cutoff_date, tables=table_dict):
+    # Table VA: records and patients per table since the cutoff date
+    metrics = []
+    for table in tables:
+        where = cutoff_filter(table, cutoff_date)
+        metrics.append(Metric(('4.01', schema, 'records', table), schema, table, 'count', '', where))
+        if table != 'PROVIDER':
+            metrics.append(Metric(('4.01', schema, 'patients', table), schema, table, 'count_distinct', 'PATID', where))
+    return metrics
+
+
+def required_check_metrics(schema):
+    return primary_key_metrics(schema) + orphan_metrics(schema)
+
+
+def percentage(numerator, denominator, digits=1):
+    # ROUND(n * 100.0 / NULLIF(d, 0), digits) with Snowflake's half-up rounding
+    if not denominator:
+        return None
+    value = Decimal(numerator) * 100 / Decimal(denominator)
+    return float(value.quantize(Decimal(1).scaleb(-digits), rounding=ROUND_HALF_UP))
+
+
+def orphan_rows(check_id, tables, metric_values, digits, zero_when_empty=False):
+    rows = []
+    for table in tables:
+        orphans = metric_values[(check_id, 'orphans', table)]
+        total = metric_values[(check_id, 'total', table)]
+        if zero_when_empty and not total:
+            pct = 0
+        else:
+            pct = percentage(orphans, total, digits)
+        rows.append({"TABLE": table, "Count": orphans, "PERCENTAGE": pct})
+    rows.sort(key=lambda row: row["Count"], reverse=True)
+    return rows
+
+
+def percent_change(previous, current):
+    # rounded half-up like percentage(), so both show .x5 values the same way
+    if not previous:
+        return None
+    return percentage(current - previous, previous, 1)
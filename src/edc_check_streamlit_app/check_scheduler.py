@@ -0,0 +1,151 @@
+# Cost model for the scheduled executor. A call is estimated from the statements with the same
+# QUERY_TAG in the query profile when there are any, otherwise from the ROW_COUNT of the tables
+# it scans times a per-check weight, at a throughput calibrated on the profile. Calls estimated
+# above heavy_seconds are routed to the heavy warehouse when a RoutedSession provides one.
+import csv
+import statistics
+
+from backends import create_session
+from metadata_catalog import row_counts
+from query_executor import default_warehouse, current_warehouse
+from query_profiler import parse_tag, profile_rows
+
+
+# relative cost per scanned row; checks not listed weigh 1
+check_weights = {
+    '1.11': 4.0,   # COUNT(DISTINCT PATID) per ENCOUNTERID
+    '1.10': 2.0,   # join to ENCOUNTER
+    '4.02': 2.0,   # join to ENCOUNTER for LAB_RESULT_CM and PRESCRIBING
+    'IB': 2.0,     # distinct patient sets intersected across tables
+    'IA': 1.5,
+    'trend': 1.5,
+    'profile': 2.0,  # rows per key and day, then a window over them
+    'keys': 0.5,
+}
+
+# rows per second assumed before any statement has been profiled
+default_rows_per_second = 20_000_000
+
+# how much faster the heavy warehouse is assumed to run a call
+default_heavy_speedup = 4.0
+
+heavy_warehouse = 'heavy'
+
+# estimated seconds above which a check goes to the heavy warehouse, when there is one
+default_heavy_seconds = 60.0
+
+
+class CostModel:
+
+    def __init__(self, session, history=(), rows_per_second=None, heavy_seconds=None, heavy_speedup=default_heavy_speedup):
+        # history: profile rows (query_profiler.profile_rows or read_history); heavy_seconds None
+        # keeps every call on the light warehouse
+        self._session = session
+        self._seconds_by_tag = {}
+        for row in history:
+            if row.get('QUERY_TAG') and not row.get('ERROR') and row.get('CLIENT_SECONDS') is not None:
+                self._seconds_by_tag.setdefault(row['QUERY_TAG'], []).append(float(row['CLIENT_SECONDS']))
+        self.rows_per_second = rows_per_second or self.calibrated_rows_per_second(history) or default_rows_per_second
+        self.heavy_seconds = heavy_seconds
+        self.heavy_speedup = heavy_speedup
+
+    def row_count(self, schema, table):
+        return row_counts(self._session, schema).get(table.upper()) or 0
+
+    def calibrated_rows_per_second(self, history, min_seconds=1.0):
+        # weighted rows over seconds of the profiled statements long enough to be scan-bound
+        rows, seconds = 0.0, 0.0
+        for row in history:
+            check_id, tables, schema = parse_tag(row.get('QUERY_TAG'))
+            if not check_id or not schema or row.get('ERROR') or float(row.get('CLIENT_SECONDS') or 0) < min_seconds:
+                continue
+            rows += check_weight(check_id) * sum(self.row_count(schema, table) for table in tables.split('+') if table)
+            seconds += float(row['CLIENT_SECONDS'])
+        return rows / seconds if rows and seconds else None
+
+    def light_seconds(self, work):
+        history = self._seconds_by_tag.get(work.tag)
+        if history:
+            return statistics.median(history)
+        check_id = parse_tag(work.tag)[0]
+        rows = sum(self.row_count(schema, table) for schema, table in work.inputs)
+        return check_weight(check_id) * rows / self.rows_per_second
+
+    def __call__(self, work):
+        seconds = self.light_seconds(work)
+        if self.heavy_seconds is not None and seconds > self.heavy_seconds:
+            return seconds / self.heavy_speedup, heavy_warehouse
+        return seconds, default_warehouse
+
+
+def check_weight(check_id):
+    # the planner tags a shared pass with every check it serves (1.05+1.08); it weighs as a scan
+    return check_weights.get(check_id, 1.0)
+
+
+def session_cost_model(session, heavy_seconds=None):
+    return CostModel(session, profile_rows(session), heavy_seconds=heavy_seconds)
+
+
+def read_history(paths):
+    # profile.csv files written by the batch runner or downloaded from the app
+    rows = []
+    for path in paths:
+        with open(path, newline='') as handle:
+            rows.extend(csv.DictReader(handle))
+    return rows
+
+
+class RoutedSession:
+    # sends each statement through the session of the warehouse tier its call was routed to;
+    # Snowflake sessions have one current warehouse, so every tier needs its own session
+
+    def __init__(self, sessions):
+        self.sessions = sessions
+
+    def sql(self, sql):
+        return self.sessions.get(current_warehouse(), self.sessions[default_warehouse]).sql(sql)
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+
+
+def create_routed_session(connection_name, light_warehouse, heavy_warehouse_name):
+    # one session per warehouse; calls estimated as heavy go through the second one
+    return RoutedSession({default_warehouse: create_session(connection_name, light_warehouse),
+                          heavy_warehouse: create_session(connection_name, heavy_warehouse_name)})
+
+
+def plan_rows(schedule, max_concurrency):
+    # list scheduling of the calls, longest first, on max_concurrency slots: when each would start
+    # and finish if the estimates held
+    slots = [0.0] * max_concurrency
+    rows = []
+    for order, call in enumerate(schedule, 1):
+        slot = min(range(max_concurrency), key=slots.__getitem__)
+        start = slots[slot]
+        slots[slot] = start + call.seconds
+        check_id, tables, schema = parse_tag(call.work.tag if call.work else None)
+        inputs = call.work.inputs if call.work else []
+        rows.append({
+            "ORDER": order,
+            "CHECK_ID": check_id,
+            "SCHEMA": schema or ', '.join(sorted({schema for schema, _ in inputs})),
+            "TABLES": tables or '+'.join(sorted({table for _, table in inputs})),
+            "WAREHOUSE": call.warehouse,
+            "ESTIMATED_SECONDS": round(call.seconds, 2),
+            "SLOT": slot + 1,
+            "START": round(start, 2),
+            "FINISH": round(slots[slot], 2),
+        })
+    return rows
+
+
+def plan_summary(rows, max_concurrency):
+    # estimated makespan against its lower bound: the longest call or the total work spread evenly
+    total = sum(row['ESTIMATED_SECONDS'] for row in rows)
+    longest = max((row['ESTIMATED_SECONDS'] for row in rows), default=0)
+    makespan = max((row['FINISH'] for row in rows), default=0)
+    return {'calls': len(rows), 'estimated_seconds': round(makespan, 2),
+            'lower_bound_seconds': round(max(longest, total / max_concurrency), 2), 'total_seconds': round(total, 2)}
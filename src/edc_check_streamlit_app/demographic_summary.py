@@ -0,0 +1,143 @@
+# Table IA. The rows of the demographic summary are defined as data and compiled into a single
+# conditional-aggregation scan of DEMOGRAPHIC joined once to the post-2011 encounter patients.
+from datetime import date
+from functools import partial
+
+from check_registry import percentage
+from query_executor import defer, work_item
+from result_store import cached_fetch_rows
+
+
+encounter_since = '2011-12-01'
+
+
+def age(as_of):
+    # ages are taken on a literal date rather than CURRENT_DATE, so the SQL (the result store key)
+    # changes with the day and a stored Table IA never shows yesterday's ages
+    return f"DATEDIFF(YEAR, BIRTH_DATE, '{as_of}'::DATE)"
+
+
+# (category, group name, kind, predicate)
+# kind: 'total' all patients, 'header' section title, 'mean_age'/'median_age',
+#       'count' patients matching the predicate (% of all patients),
+#       'age_count' same for an age group, the predicate being its (lowest, highest) age or None if open,
+#       'encounter_count' same but restricted to patients with an encounter after encounter_since
+demographic_summary_spec = [
+    ('Patients', '', 'total', ''),
+    ('Age', '', 'header', ''),
+    ('', 'Mean', 'mean_age', ''),
+    ('', 'Median', 'median_age', ''),
+    ('Age group', '', 'header', ''),
+    ('', '0-4', 'age_count', (None, 4)),
+    ('', '5-14', 'age_count', (5, 14)),
+    ('', '15-21', 'age_count', (15, 21)),
+    ('', '22-64', 'age_count', (22, 64)),
+    ('', '65+', 'age_count', (65, None)),
+    ('', 'Missing', 'count', "BIRTH_DATE IS NULL"),
+    ('Hispanic', '', 'header', ''),
+    ('', 'N (No)', 'count', "HISPANIC = 'N'"),
+    ('', 'Y (Yes)', 'count', "HISPANIC = 'Y'"),
+    ('', 'Missing or Refused', 'count', "HISPANIC = 'R' OR HISPANIC IS NULL"),
+    ('Sex', '', 'header', ''),
+    ('', 'F (Female)', 'count', "SEX = 'F'"),
+    ('', 'M (Male)', 'count', "SEX = 'M'"),
+    ('', 'Missing or Ambiguous', 'count', "SEX IS NULL"),
+    ('Race', '', 'header', ''),
+    ('', 'White', 'count', "RACE = '05'"),
+    ('', 'Non-White', 'count', "RACE IN ('01','02','03','04','06')"),
+    ('', 'Missing or Refused', 'count', "RACE IN ('07','NI','UN','OT') OR RACE IS NULL"),
+    ('Race among patients with at least 1 encounter after December 2011', '', 'header', ''),
+    ('', 'White', 'encounter_count', "RACE = '05'"),
+    ('', 'Non-White', 'encounter_count', "RACE IN ('01','02','03','04','06')"),
+    ('', 'Missing or Refused', 'encounter_count', "RACE IN ('07','NI','UN','OT') OR RACE IS NULL"),
+    ('Gender Identity', '', 'header', ''),
+    ('', 'GQ (Genderqueer/Non-Binary)', 'count', "GENDER_IDENTITY = 'GQ'"),
+    ('', 'M (Man)', 'count', "GENDER_IDENTITY = 'M'"),
+    ('', 'W (Woman)', 'count', "GENDER_IDENTITY = 'W'"),
+    ('', 'MU (Multiple gender categories), SE (Something else),TF (Transgender female/Trans woman/Male-to-female), or TM (Transgender male/Trans man/Female-to-male)', 'count', "GENDER_IDENTITY IN ('MU','SE','TF','TM')"),
+    ('', 'Missing or Refused', 'count', "GENDER_IDENTITY IN ('DC','NI','UN','OT') OR GENDER_IDENTITY IS NULL"),
+    ('Sexual Orientation', '', 'header', ''),
+    ('', 'Bisexual', 'count', "SEXUAL_ORIENTATION = 'BI'"),
+    ('', 'Gay', 'count', "SEXUAL_ORIENTATION = 'GA'"),
+    ('', 'Lesbian', 'count', "SEXUAL_ORIENTATION = 'LE'"),
+    ('', 'Queer', 'count', "SEXUAL_ORIENTATION = 'QU'"),
+    ('', 'Straight', 'count', "SEXUAL_ORIENTATION = 'ST'"),
+    ('', 'AS (Asexual), MU (Multiple sexual orientations),SE (Something else), QS (Questioning)', 'count', "SEXUAL_ORIENTATION IN ('AS','MU','SE','QS')"),
+    ('', 'Missing or Refused', 'count', "SEXUAL_ORIENTATION IN ('DC','NI','UN','OT') OR SEXUAL_ORIENTATION IS NULL"),
+]
+
+
+def age_group(as_of, lowest, highest):
+    bounds = [f"{age(as_of)} >= {lowest}" if lowest is not None else '',
+              f"{age(as_of)} <= {highest}" if highest is not None else '']
+    return ' AND '.join(bound for bound in bounds if bound)
+
+
+def summary_column(kind, predicate, as_of):
+    if kind == 'mean_age':
+        return f"CAST(AVG({age(as_of)}) AS INT)"
+    if kind == 'median_age':
+        return f"CAST(PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY {age(as_of)}) AS INT)"
+    if kind == 'count':
+        return f"COUNT_IF(D.IN_DEMOGRAPHIC = 1 AND ({predicate}))"
+    if kind == 'age_count':
+        return f"COUNT_IF(D.IN_DEMOGRAPHIC = 1 AND ({age_group(as_of, *predicate)}))"
+    if kind == 'encounter_count':
+        return f"COUNT_IF(D.IN_DEMOGRAPHIC = 1 AND E.PATID IS NOT NULL AND ({predicate}))"
+    raise ValueError(f"Unknown demographic summary kind '{kind}'")
+
+
+def compile_demographic_summary(schema, as_of=None, spec=demographic_summary_spec):
+    as_of = as_of or date.today()
+    columns = ["COUNT(D.IN_DEMOGRAPHIC) AS TOTAL_PATIENTS", "COUNT(DISTINCT E.PATID) AS TOTAL_PATIENTS_WITH_ENC"]
+    for i, (_, _, kind, predicate) in enumerate(spec):
+        if kind not in ('header', 'total'):
+            columns.append(f"{summary_column(kind, predicate, as_of)} AS C{i}")
+    select = ",\n               ".join(columns)
+    # FULL JOIN keeps encounter patients missing from DEMOGRAPHIC in the encounter denominator
+    return f"""
+        WITH encounter_patients AS (
+            SELECT DISTINCT PATID FROM {schema}.encounter WHERE ADMIT_DATE > '{encounter_since}'
+        )
+        SELECT {select}
+        FROM (SELECT *, 1 AS IN_DEMOGRAPHIC FROM {schema}.demographic) D
+        FULL OUTER JOIN encounter_patients E ON E.PATID = D.PATID
+    """
+
+
+def format_percentage(numerator, denominator):
+    if not denominator:
+        return ''
+    return f"{percentage(numerator, denominator, 1):g}%"
+
+
+def demographic_summary_rows(values, spec=demographic_summary_spec):
+    total_patients = values['TOTAL_PATIENTS']
+    total_patients_with_enc = values['TOTAL_PATIENTS_WITH_ENC']
+    rows = []
+    for i, (category, group_name, kind, _) in enumerate(spec):
+        if kind == 'header':
+            n = ''
+        elif kind == 'total':
+            n = total_patients
+        else:
+            n = values[f"C{i}"]
+        if kind in ('count', 'age_count'):
+            pct = format_percentage(n, total_patients)
+        elif kind == 'encounter_count':
+            pct = format_percentage(n, total_patients_with_enc)
+        else:
+            pct = ''
+        rows.append({
+            "CATEGORY": category,
+            "GROUP_NAME": group_name,
+            "N": n if n is None or n == '' else str(n),
+            "ROW_ORDER": i + 1,
+            "PERCENTAGE": pct
+        })
+    return rows
+
+
+def submit_demographic_summary(executor, session, schema, store=None, as_of=None):
+    call = partial(cached_fetch_rows, store, session, schema, 'IA', ['DEMOGRAPHIC', 'ENCOUNTER'], compile_demographic_summary(schema, as_of))
+    return defer(executor, [call], lambda results: demographic_summary_rows(results[0][0]), [work_item('IA', schema, ['DEMOGRAPHIC', 'ENCOUNTER'])])
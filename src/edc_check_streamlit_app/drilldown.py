@@ -0,0 +1,205 @@
+# The rows behind a flagged check: duplicate primary keys (1.05), orphan keys (1.08, 1.09, 1.12),
+# replication mismatches (1.10), encounters with several patients (1.11) and the months a table
+# lost records in (4.01). Rows are streamed from the warehouse in result batches, a page at a time
+# for the app and to CSV or Parquet in chunks for export, so millions of exception rows are never
+# held in memory at once.
+import csv
+import os
+
+from check_registry import (table_dict, primary_key_dict, patid_tables, encounterid_tables, replication_tables,
+                            encounter_patient_tables, provider_tables, cutoff_filter, decrease_threshold)
+from html_tables import default_page_size
+from integrity_checks import (replication_exception_sql, encounter_patient_relation, materialize_encounter_patients,
+                              encounter_patient_exception_sql)
+from key_sets import inline_key_set
+from query_profiler import query_tag
+from warehouse import stream_rows, column_types, missing_object
+
+
+# rows written per Parquet row group
+export_batch_rows = 100_000
+
+# Snowpark DataType class name -> Arrow type of the exported column; others are written as strings
+arrow_type_names = {
+    'StringType': 'string', 'LongType': 'int64', 'IntegerType': 'int64', 'ShortType': 'int64', 'ByteType': 'int64',
+    'DoubleType': 'float64', 'FloatType': 'float64', 'DateType': 'date32', 'BooleanType': 'bool_',
+}
+
+# check id -> (title, tables it can be drilled into)
+drilldown_checks = {
+    '1.05': ("Duplicate primary keys", list(primary_key_dict)),
+    '1.08': ("Orphan PATIDs", patid_tables),
+    '1.09': ("Orphan ENCOUNTERIDs", encounterid_tables),
+    '1.10': ("Replication errors", replication_tables),
+    '1.11': ("Encounters assigned to more than one patient", encounter_patient_tables),
+    '1.12': ("Orphan PROVIDERIDs", list(provider_tables)),
+    '4.01': ("Records per month", [table for table in table_dict if table_dict[table]]),
+}
+
+# orphan check id -> key set its keys are missing from
+orphan_key_sets = {'1.08': 'PATID', '1.09': 'ENCOUNTERID', '1.12': 'PROVIDERID'}
+
+
+def flagged_tables(check_id, rows):
+    # tables of a check's result rows that have anything to drill into
+    if check_id == '1.05':
+        return [row['TABLE'] for row in rows if row['Exception to specifications'] == 'Yes']
+    if check_id == '4.01':
+        return [row['TABLE_NAME'] for row in rows
+                if row['TABLE_NAME'] in drilldown_checks['4.01'][1] and (row['RECORD_CHANGE'] or 0) < decrease_threshold]
+    return [row['TABLE'] for row in rows if row['Count']]
+
+
+def duplicate_key_sql(schema, table):
+    key = primary_key_dict[table][0]
+    return f"""SELECT {key} AS PRIMARY_KEY, COUNT(*) AS ROWS_WITH_KEY FROM {schema}.{table}
+        GROUP BY {key} HAVING COUNT(*) > 1 ORDER BY PRIMARY_KEY"""
+
+
+def orphan_key_sql(check_id, schema, table):
+    # the anti-join of the planner pass, keeping the keys instead of counting them
+    name = orphan_key_sets[check_id]
+    column = provider_tables[table] if check_id == '1.12' else name
+    return f"""SELECT T.{column} AS {name}, COUNT(*) AS ROWS_WITH_KEY FROM {schema}.{table} T
+        LEFT JOIN {inline_key_set(schema, name)} K ON K.KEY_VALUE = T.{column}
+        WHERE K.KEY_VALUE IS NULL AND T.{column} IS NOT NULL
+        GROUP BY T.{column} ORDER BY {name}"""
+
+
+def monthly_records_sql(schema, last_schema, table, cutoff_date):
+    # records per month since the cutoff in both refreshes, to see where a decrease comes from
+    col = table_dict[table]
+
+    def months(from_schema):
+        return f"""SELECT DATE_TRUNC('MONTH', {col})::DATE AS MONTH, COUNT(*) AS RECORDS
+            FROM {from_schema}.{table} WHERE {cutoff_filter(table, cutoff_date)} GROUP BY 1"""
+    return f"""SELECT COALESCE(c.MONTH, p.MONTH) AS MONTH, COALESCE(p.RECORDS, 0) AS PREVIOUS_RECORD,
+            COALESCE(c.RECORDS, 0) AS CURRENT_RECORD, ROUND((COALESCE(c.RECORDS, 0) - p.RECORDS) * 100.0 / NULLIF(p.RECORDS, 0), 1) AS RECORD_CHANGE
+        FROM ({months(schema)}) c FULL OUTER JOIN ({months(last_schema)}) p ON c.MONTH = p.MONTH
+        ORDER BY MONTH"""
+
+
+def exception_sql(session, check_id, schema, table, cutoff_date=None, last_schema=None):
+    if check_id == '1.05':
+        return duplicate_key_sql(schema, table)
+    if check_id in orphan_key_sets:
+        return orphan_key_sql(check_id, schema, table)
+    if check_id == '1.10':
+        return replication_exception_sql(schema, table)
+    if check_id == '1.11':
+        return encounter_patient_exception_sql(encounter_patient_relation(session, schema, cutoff_date), table)
+    if check_id == '4.01':
+        return monthly_records_sql(schema, last_schema, table, cutoff_date)
+    raise ValueError(f"No drill-down for check '{check_id}'")
+
+
+def exception_rows(session, check_id, schema, table, cutoff_date=None, last_schema=None):
+    # generator over the exception rows in a stable order; close it to stop the statement's results
+    return stream_rows(session, exception_sql(session, check_id, schema, table, cutoff_date, last_schema),
+                       query_tag(check_id, [table], schema))
+
+
+def rebuilding_projection(session, check_id, schema, cutoff_date, run):
+    # a 1.11 drill-down reads the temporary table of its run; when that is gone with its session
+    # (or was created on another warehouse's session), the projection is rebuilt once. Any other
+    # failure, a timeout above all, is not worth rebuilding the most expensive check for.
+    try:
+        return run()
+    except Exception as error:
+        if check_id != '1.11' or not missing_object(error):
+            raise
+        materialize_encounter_patients(session, schema, cutoff_date)
+        return run()
+
+
+class ExceptionPager:
+    # the exception rows of one drill-down from a single statement: a page pulls the next result
+    # batches of the open stream only as far as it reaches, and the rows already read are kept, so
+    # paging back never runs the statement again. close() abandons the rest of the result.
+    def __init__(self, session, check_id, schema, table, cutoff_date=None, last_schema=None, page_size=default_page_size):
+        self.key = (check_id, schema, table, cutoff_date, last_schema)
+        self.page_size = page_size
+        self.rows = []
+        self.exhausted = False
+
+        def start():
+            # the statement runs on the first pull, which is where a lost 1.11 projection shows
+            stream = exception_rows(session, check_id, schema, table, cutoff_date, last_schema)
+            return stream, next(stream, None)
+        self._stream, first = rebuilding_projection(session, check_id, schema, cutoff_date, start)
+        if first is None:
+            self.close()
+        else:
+            self.rows.append(first)
+
+    def page(self, page):
+        end = (page + 1) * self.page_size
+        while len(self.rows) < end and not self.exhausted:
+            row = next(self._stream, None)
+            if row is None:
+                self.close()
+            else:
+                self.rows.append(row)
+        return self.rows[page * self.page_size:end]
+
+    def close(self):
+        if not self.exhausted:
+            self._stream.close()
+            self.exhausted = True
+
+
+def write_csv(rows, path):
+    count = 0
+    with open(path, 'w', newline='') as handle:
+        writer = None
+        for row in rows:
+            if writer is None:
+                writer = csv.DictWriter(handle, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def arrow_type(pa, datatype):
+    name = getattr(datatype, 'type_name', type(datatype).__name__)
+    if name == 'DecimalType':
+        # NUMBER(p, 0) keys and counts come back as Python ints
+        return pa.int64() if not datatype.scale else pa.decimal128(datatype.precision, datatype.scale)
+    if name == 'TimestampType':
+        return pa.timestamp('us')
+    return getattr(pa, arrow_type_names.get(name, 'string'))()
+
+
+def write_parquet(rows, path, columns, batch_rows=export_batch_rows):
+    # one row group per batch; the schema comes from the statement's column types, so a column
+    # that is NULL throughout the first batch is still typed
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([(name, arrow_type(pa, datatype)) for name, datatype in columns])
+    count = 0
+    batch = []
+    with pq.ParquetWriter(path, schema) as writer:
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_rows:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                count += len(batch)
+                batch = []
+        if batch or not count:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            count += len(batch)
+    return count
+
+
+def export_exceptions(session, check_id, schema, table, path, cutoff_date=None, last_schema=None):
+    # every exception row of a table to CSV or Parquet (by the extension of path); returns the rows written
+    def export():
+        rows = exception_rows(session, check_id, schema, table, cutoff_date, last_schema)
+        try:
+            if os.path.splitext(path)[1].lower() == '.parquet':
+                return write_parquet(rows, path, column_types(session, exception_sql(session, check_id, schema, table, cutoff_date, last_schema)))
+            return write_csv(rows, path)
+        finally:
+            rows.close()
+    return rebuilding_projection(session, check_id, schema, cutoff_date, export)
@@ -0,0 +1,90 @@
+# Approximate distinct patients. Every dated table keeps one exported HyperLogLog sketch of PATID
+# per month (HLL_EXPORT(HLL_ACCUMULATE(PATID))) in the result store; the patients of any window
+# are estimated by sending the sketches of its months back to HLL_COMBINE/HLL_ESTIMATE, which
+# scans no table, so a new cutoff date only costs a pruned scan of the month it falls in.
+import json
+import math
+from datetime import date
+
+from check_registry import table_dict
+from query_profiler import query_tag
+from result_store import cached_rows, cached_fetch_rows
+from warehouse import fetch_rows
+
+
+# estimates are reported with a +/- this many standard errors (~95%)
+error_sigmas = 2
+
+# precision of Snowflake's HLL functions and APPROX_COUNT_DISTINCT
+default_precision = 12
+
+
+def relative_standard_error(precision=default_precision):
+    return 1.04 / math.sqrt(1 << precision)
+
+
+# sketches combined per statement, which keeps the statement text well under Snowflake's limit
+sketches_per_statement = 50
+
+
+def sketch_text(sketch):
+    return sketch if isinstance(sketch, str) else json.dumps(sketch)
+
+
+def sketch_precision(sketch):
+    # only the precision is read client-side, for the error of the estimate
+    return json.loads(sketch_text(sketch))['precision']
+
+
+def combine_sketches_sql(sketches, result):
+    # result: 'HLL_EXPORT' for a combined sketch, 'HLL_ESTIMATE' for its distinct count
+    values = ", ".join("('{}')".format(sketch_text(sketch).replace("'", "''")) for sketch in sketches)
+    return f"SELECT {result}(HLL_COMBINE(HLL_IMPORT(PARSE_JSON(COLUMN1)))) AS RESULT FROM VALUES {values}"
+
+
+def merged_estimate(session, sketches, tag=None):
+    # distinct count of the union of the sketched sets. Snowflake combines and estimates with the
+    # estimator of APPROX_COUNT_DISTINCT, so no register format is interpreted here. A month or partial month without
+    # PATIDs has a NULL sketch and adds nothing.
+    sketches = [sketch for sketch in sketches if sketch is not None]
+    if not sketches:
+        return 0
+    while len(sketches) > sketches_per_statement:
+        sketches = [fetch_rows(session, combine_sketches_sql(sketches[first:first + sketches_per_statement], 'HLL_EXPORT'), tag)[0]['RESULT']
+                    for first in range(0, len(sketches), sketches_per_statement)]
+    return int(fetch_rows(session, combine_sketches_sql(sketches, 'HLL_ESTIMATE'), tag)[0]['RESULT'])
+
+
+def monthly_sketch_sql(schema, table):
+    col = table_dict[table]
+    return f"""SELECT DATE_TRUNC('MONTH', {col})::DATE AS MONTH, COUNT(*) AS RECORDS, HLL_EXPORT(HLL_ACCUMULATE(PATID)) AS PATIENT_SKETCH
+        FROM {schema}.{table} WHERE {col} IS NOT NULL GROUP BY 1"""
+
+
+def partial_month_sql(schema, table, cutoff_date):
+    # the month the cutoff falls in is only partly inside the window; a range on it prunes
+    col = table_dict[table]
+    month_start = date(cutoff_date.year, cutoff_date.month, 1)
+    next_month = date(month_start.year + month_start.month // 12, month_start.month % 12 + 1, 1)
+    return f"""SELECT COUNT(*) AS RECORDS, HLL_EXPORT(HLL_ACCUMULATE(PATID)) AS PATIENT_SKETCH
+        FROM {schema}.{table} WHERE {col} >= '{cutoff_date}' AND {col} < '{next_month}'"""
+
+
+def monthly_sketches(session, schema, table, store=None):
+    sql = monthly_sketch_sql(schema, table)
+    return cached_rows(store, session, schema, 'HLL', [table], sql, lambda: fetch_rows(session, sql, query_tag('HLL', [table], schema)))
+
+
+def window_counts(session, schema, table, cutoff_date, store=None):
+    # (records, estimated patients, precision) on or after cutoff_date; records are exact
+    month_start = date(cutoff_date.year, cutoff_date.month, 1)
+    rows = []
+    for row in monthly_sketches(session, schema, table, store):
+        month = date.fromisoformat(str(row['MONTH'])[:10])
+        if month > month_start or (month == month_start and cutoff_date == month_start):
+            rows.append(row)
+    if cutoff_date != month_start:
+        rows += cached_fetch_rows(store, session, schema, 'HLL', [table], partial_month_sql(schema, table, cutoff_date))
+    sketches = [row['PATIENT_SKETCH'] for row in rows if row['PATIENT_SKETCH'] is not None]
+    precision = sketch_precision(sketches[0]) if sketches else None
+    return sum(row['RECORDS'] for row in rows), merged_estimate(session, sketches, query_tag('HLL', [table], schema)), precision
@@ -0,0 +1,82 @@
+# Columnar HTML renderer for check results. Cells carry short CSS classes defined once in
+# table_css instead of an inline style each, and the red/bold rules are evaluated as masks over
+# whole columns, so rendering time and payload stay proportional to what is actually shown.
+# pandas is imported on first use so that importing this module stays cheap on reruns.
+from html import escape
+
+
+default_page_size = 500
+
+table_css = """<style>
+table.edc-table {width:95%; border-collapse:collapse; border:1px solid black; margin:25px auto;}
+table.edc-table th {border:1px solid black; padding:8px; text-align:center; background-color:#4CAF50; color:white; min-width:300px;}
+table.edc-table td {border:1px solid black; padding:8px; text-align:center; color:black;}
+table.edc-table td.r {color:red;}
+table.edc-table td.b {font-weight:bold;}
+table.edc-change {width:100%; margin:0;}
+table.edc-change th {min-width:0; width:450px;}
+</style>"""
+
+
+def exceeds(red_value):
+    # generic tables: strings equal to red_value, other values greater than it
+    def mask(values):
+        import pandas as pd
+        if isinstance(red_value, str):
+            return values.notna() & (values == red_value)
+        return pd.to_numeric(values, errors='coerce') > red_value
+    return mask
+
+
+def below(threshold):
+    # change tables: percent changes under the threshold
+    def mask(values):
+        import pandas as pd
+        return pd.to_numeric(values, errors='coerce') < threshold
+    return mask
+
+
+def to_frame(rows):
+    import pandas as pd
+    if isinstance(rows, pd.DataFrame):
+        return rows
+    # object dtype keeps ints, Decimals and None exactly as the warehouse returned them
+    return pd.DataFrame(list(rows), dtype=object)
+
+
+def page_bounds(row_count, page, page_size=default_page_size):
+    start = min(page * page_size, max(row_count - 1, 0) // page_size * page_size)
+    return start, min(start + page_size, row_count)
+
+
+def cell_texts(values):
+    texts = list(map(str, values.tolist()))
+    # codes, dates and counts never need escaping; only pay for it when a column holds markup
+    joined = ''.join(texts)
+    if '<' in joined or '>' in joined or '&' in joined:
+        return [escape(text, quote=False) for text in texts]
+    return texts
+
+
+def cell_openings(red, bold):
+    import numpy as np
+    return np.where(red, np.where(bold, '<td class="r b">', '<td class="r">'), np.where(bold, '<td class="b">', '<td>')).tolist()
+
+
+def table_html(rows, red_columns=(), red_when=None, bold_columns=(), ignore_columns=(), css_class='edc-table', start=0, stop=None):
+    # only the requested page is converted; list results are sliced before they become a frame
+    frame = to_frame(rows[start:stop] if isinstance(rows, list) else rows.iloc[start:stop])
+    columns = [column for column in frame.columns if column not in ignore_columns]
+    headers = ''.join(f'<th>{escape(str(column))}</th>' for column in columns)
+
+    cells = []
+    for column in columns:
+        values = frame[column]
+        red = (red_when(values).fillna(False).to_numpy(bool) if red_when and column in red_columns else False)
+        bold = values.notna().to_numpy() if column in bold_columns else False
+        cells.append(cell_openings(red, bold) if red is not False or bold is not False else ['<td>'] * len(values))
+        cells.append(cell_texts(values))
+    # one str.format call per row instead of a concatenation per cell
+    row_template = '<tr>' + '{}{}</td>' * len(columns) + '</tr>'
+    rows_html = ''.join(map(row_template.format, *cells)) if columns else ''
+    return f'<table class="{css_class}"><tr>{headers}</tr>{rows_html}</table>'
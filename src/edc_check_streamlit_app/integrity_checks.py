@@ -0,0 +1,170 @@
+# Required checks (Tables IIA and IIE). Every check is submitted up front and resolved in report
+# order; 1.05, 1.08, 1.09 and 1.12 share the planner's single pass per table, and 1.11 reads one
+# (table, ENCOUNTERID, PATID) projection of all its tables that later drill-downs page through.
+from functools import partial
+
+from check_registry import (primary_key_dict, patid_tables, encounterid_tables, replication_tables, encounter_patient_tables,
+                            provider_tables, required_check_metrics, cutoff_filter, orphan_rows, percentage)
+from query_executor import Deferred, defer, work_item
+from query_planner import submit_metrics
+from query_profiler import query_tag
+from result_store import cached_rows, cached_fetch_rows
+from warehouse import fetch_rows
+
+
+def primary_key_rows(metric_values):
+    rows = []
+    for table, (_, specification) in primary_key_dict.items():
+        distinct_keys = metric_values[('1.05', 'keys', table)]
+        total_rows = metric_values[('1.05', 'rows', table)]
+        rows.append({
+            "TABLE": table,
+            "CDM specifications for primary keys": specification,
+            "Exception to specifications": 'No' if distinct_keys == total_rows else 'Yes'
+        })
+    return rows
+
+
+# 1.10 mismatch category -> condition on a DIAGNOSIS/PROCEDURES row d and its encounter e, the
+# first that holds naming the row's category
+mismatch_categories = {
+    'ENC_TYPE & ADMIT_DATE': "d.ENC_TYPE != e.ENC_TYPE AND d.ADMIT_DATE != e.ADMIT_DATE",
+    'ENC_TYPE': "d.ENC_TYPE != e.ENC_TYPE",
+    'ADMIT_DATE': "d.ADMIT_DATE != e.ADMIT_DATE",
+}
+
+
+def replication_mismatch_sql(current_schema):
+    # mismatching rows of every replication table, from one join to ENCOUNTER
+    rows = "\n                UNION ALL\n                ".join(
+        f"SELECT '{table}' AS TABLE_NAME, {primary_key_dict[table][0]} AS ROW_ID, ENCOUNTERID, ENC_TYPE, ADMIT_DATE FROM {current_schema}.{table}"
+        for table in replication_tables)
+    category = " ".join(f"WHEN {condition} THEN '{name}'" for name, condition in mismatch_categories.items())
+    return f"""SELECT d.TABLE_NAME, d.ROW_ID, d.ENCOUNTERID, CASE {category} END AS MISMATCH_FIELDS,
+            d.ENC_TYPE, e.ENC_TYPE AS ENCOUNTER_ENC_TYPE, d.ADMIT_DATE, e.ADMIT_DATE AS ENCOUNTER_ADMIT_DATE
+        FROM ({rows}) d JOIN {current_schema}.encounter e ON d.ENCOUNTERID = e.ENCOUNTERID
+        WHERE (d.ENC_TYPE != e.ENC_TYPE OR d.ADMIT_DATE != e.ADMIT_DATE)"""
+
+
+def replication_sql(current_schema):
+    # mismatches per table and category; constant-size however many rows mismatch
+    counts = ", ".join(f"COUNT_IF(MISMATCH_FIELDS = '{name}') AS \"{name}\"" for name in mismatch_categories)
+    return f"""SELECT TABLE_NAME AS "TABLE", COUNT(*) AS "Count", {counts}
+        FROM ({replication_mismatch_sql(current_schema)}) mismatches
+        GROUP BY TABLE_NAME"""
+
+
+def replication_rows(count_rows):
+    counts = {row['TABLE']: row for row in count_rows}
+    rows = []
+    for table in replication_tables:
+        count = counts.get(table, {})
+        rows.append({"TABLE": table, "Count": count.get('Count') or 0,
+                     **{category: count.get(category) or 0 for category in mismatch_categories}})
+    return rows
+
+
+def replication_exception_sql(current_schema, table):
+    # the mismatching rows of one table behind its 1.10 count
+    return f"""SELECT ROW_ID, ENCOUNTERID, MISMATCH_FIELDS, ENC_TYPE, ENCOUNTER_ENC_TYPE, ADMIT_DATE, ENCOUNTER_ADMIT_DATE
+        FROM ({replication_mismatch_sql(current_schema)}) mismatches WHERE TABLE_NAME = '{table}'
+        ORDER BY ROW_ID"""
+
+
+def encounter_patient_projection_sql(current_schema, cutoff_date):
+    # distinct (table, ENCOUNTERID, PATID) of every 1.11 table in one projection; IN_WINDOW marks
+    # the pairs seen on or after the cutoff, the only ones the numerator counts
+    branches = []
+    for table in encounter_patient_tables:
+        in_window = cutoff_filter(table, cutoff_date) or '1 = 1'
+        branches.append(f"""SELECT '{table}' AS TABLE_NAME, ENCOUNTERID, PATID, MAX(CASE WHEN {in_window} THEN 1 ELSE 0 END) AS IN_WINDOW
+            FROM {current_schema}.{table} WHERE ENCOUNTERID IS NOT NULL GROUP BY ENCOUNTERID, PATID""")
+    return "\nUNION ALL\n".join(branches)
+
+
+def encounter_patient_table(current_schema, cutoff_date):
+    return f"EDC_ENCOUNTER_PATIENTS_{current_schema}_{cutoff_date:%Y%m%d}"
+
+
+# (session id, schema, cutoff date) -> relation holding the projection of that run
+_encounter_patient_relations = {}
+
+
+def materialize_encounter_patients(session, current_schema, cutoff_date):
+    # kept as a temporary table so drill-downs page through it instead of scanning the tables
+    # again; without the privilege to create one, the projection stays an inline subquery
+    temp_table = encounter_patient_table(current_schema, cutoff_date)
+    try:
+        fetch_rows(session, f"CREATE OR REPLACE TEMPORARY TABLE {temp_table} AS {encounter_patient_projection_sql(current_schema, cutoff_date)}",
+                   query_tag('1.11', encounter_patient_tables, current_schema))
+        relation = temp_table
+    except Exception:
+        relation = f"({encounter_patient_projection_sql(current_schema, cutoff_date)})"
+    _encounter_patient_relations[(id(session), current_schema, cutoff_date)] = relation
+    return relation
+
+
+def encounter_patient_relation(session, current_schema, cutoff_date):
+    return (_encounter_patient_relations.get((id(session), current_schema, cutoff_date))
+            or materialize_encounter_patients(session, current_schema, cutoff_date))
+
+
+def encounter_patients_sql(relation):
+    # per encounter: the distinct PATIDs it has on or after the cutoff
+    return f"""SELECT TABLE_NAME, ENCOUNTERID, SUM(CASE WHEN IN_WINDOW = 1 AND PATID IS NOT NULL THEN 1 ELSE 0 END) AS PATIENTS,
+            LISTAGG(CASE WHEN IN_WINDOW = 1 THEN PATID END, ', ') AS PATIDS
+        FROM {relation} GROUP BY TABLE_NAME, ENCOUNTERID"""
+
+
+def encounter_patient_counts_sql(relation):
+    # numerator (encounters with more than one patient) and denominator (all encounters) together
+    return f"""SELECT TABLE_NAME AS "TABLE", SUM(CASE WHEN PATIENTS > 1 THEN 1 ELSE 0 END) AS "Count", COUNT(*) AS ENCOUNTERS
+        FROM (SELECT TABLE_NAME, ENCOUNTERID, SUM(CASE WHEN IN_WINDOW = 1 AND PATID IS NOT NULL THEN 1 ELSE 0 END) AS PATIENTS
+              FROM {relation} GROUP BY TABLE_NAME, ENCOUNTERID) encounters
+        GROUP BY TABLE_NAME"""
+
+
+def encounter_patient_counts(session, current_schema, cutoff_date, store=None):
+    def compute():
+        relation = materialize_encounter_patients(session, current_schema, cutoff_date)
+        return fetch_rows(session, encounter_patient_counts_sql(relation), query_tag('1.11', encounter_patient_tables, current_schema))
+    return cached_rows(store, session, current_schema, '1.11', encounter_patient_tables,
+                       encounter_patient_projection_sql(current_schema, cutoff_date), compute)
+
+
+def encounter_patient_rows(count_rows):
+    counts = {row['TABLE']: row for row in count_rows}
+    rows = []
+    for table in encounter_patient_tables:
+        count = counts.get(table, {})
+        encounters = count.get('ENCOUNTERS') or 0
+        rows.append({"TABLE": table, "Count": count.get('Count') or 0,
+                     "PERCENTAGE": percentage(count['Count'], encounters, 2) if encounters else 0})
+    rows.sort(key=lambda row: row["Count"], reverse=True)
+    return rows
+
+
+def encounter_patient_exception_sql(relation, table):
+    # the encounters of one table behind its 1.11 count, with their PATIDs
+    return f"""SELECT ENCOUNTERID, PATIENTS, PATIDS FROM ({encounter_patients_sql(relation)}) encounters
+        WHERE TABLE_NAME = '{table}' AND PATIENTS > 1 ORDER BY ENCOUNTERID"""
+
+
+def submit_required_checks(executor, session, current_schema, cutoff_date, store=None):
+    # check id -> Deferred, in report order
+    planned = submit_metrics(executor, session, required_check_metrics(current_schema), store)
+
+    def from_metrics(build):
+        return Deferred(planned.futures, lambda results: build(planned.build(results)))
+
+    replication = partial(cached_fetch_rows, store, session, current_schema, '1.10', replication_tables + ['ENCOUNTER'], replication_sql(current_schema))
+    encounter_patients = partial(encounter_patient_counts, session, current_schema, cutoff_date, store)
+    return {
+        '1.05': from_metrics(primary_key_rows),
+        '1.08': from_metrics(lambda values: orphan_rows('1.08', patid_tables, values, 1)),
+        '1.09': from_metrics(lambda values: orphan_rows('1.09', encounterid_tables, values, 2, zero_when_empty=True)),
+        '1.10': defer(executor, [replication], lambda results: replication_rows(results[0]), [work_item('1.10', current_schema, replication_tables + ['ENCOUNTER'])]),
+        '1.11': defer(executor, [encounter_patients], lambda results: encounter_patient_rows(results[0]),
+                      [work_item('1.11', current_schema, encounter_patient_tables)]),
+        '1.12': from_metrics(lambda values: orphan_rows('1.12', provider_tables, values, 1)),
+    }
@@ -0,0 +1,39 @@
+# Parent key sets for the orphan checks (1.08, 1.09, 1.12). Each set is built once per run
+# as a temporary table and the child tables are anti-joined against it by the query planner.
+from query_profiler import query_tag
+from warehouse import fetch_rows
+
+
+# key set name -> (parent table, key column)
+key_set_dict = {
+    'PATID': ('DEMOGRAPHIC', 'PATID'),
+    'ENCOUNTERID': ('ENCOUNTER', 'ENCOUNTERID'),
+    'PROVIDERID': ('PROVIDER', 'PROVIDERID'),
+}
+
+
+def key_set_sql(schema, name):
+    table, column = key_set_dict[name]
+    return f"SELECT DISTINCT {column} AS KEY_VALUE FROM {schema}.{table} WHERE {column} IS NOT NULL"
+
+
+def key_set_table(schema, name):
+    return f"EDC_KEYS_{schema}_{name}"
+
+
+def inline_key_set(schema, name):
+    return f"({key_set_sql(schema, name)})"
+
+
+def materialize_key_sets(session, schema, names=None):
+    relations = {}
+    for name in names or key_set_dict:
+        temp_table = key_set_table(schema, name)
+        try:
+            fetch_rows(session, f"CREATE OR REPLACE TEMPORARY TABLE {temp_table} AS {key_set_sql(schema, name)}",
+                       query_tag('keys', [key_set_dict[name][0]], schema))
+            relations[(schema, name)] = temp_table
+        except Exception:
+            # no privilege to create tables in the app schema: fall back to an inline subquery
+            relations[(schema, name)] = inline_key_set(schema, name)
+    return relations
@@ -0,0 +1,54 @@
+# Process-wide catalog of warehouse metadata. Streamlit re-executes app.py on every widget
+# interaction but keeps imported modules, so the INFORMATION_SCHEMA reads cached here happen at
+# most once per TTL per process instead of on every click.
+import threading
+import time
+
+from query_profiler import query_tag
+from warehouse import fetch_rows
+
+
+catalog_ttl_seconds = 600
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def _cached(key, ttl, load):
+    now = time.monotonic()
+    with _lock:
+        cached = _cache.get(key)
+    if cached and now - cached[0] < ttl:
+        return cached[1]
+    value = load()
+    with _lock:
+        _cache[key] = (now, value)
+    return value
+
+
+def invalidate(schema=None):
+    with _lock:
+        for key in list(_cache):
+            if schema is None or schema in key:
+                del _cache[key]
+
+
+def list_schemas(session, pattern='CDM%', ttl=catalog_ttl_seconds):
+    return list(schema_created(session, pattern, ttl))
+
+
+def schema_created(session, pattern='CDM%', ttl=catalog_ttl_seconds):
+    # schema name -> CREATED, when the refresh was loaded
+    sql = f"SELECT SCHEMA_NAME, CREATED FROM INFORMATION_SCHEMA.SCHEMATA where SCHEMA_NAME like '{pattern}'"
+    return _cached(('schemas', pattern), ttl, lambda: {row['SCHEMA_NAME']: row['CREATED'] for row in fetch_rows(session, sql, query_tag('metadata', ['SCHEMATA']))})
+
+
+def table_info(session, schema, ttl=catalog_ttl_seconds):
+    # table name -> {'TABLE_TYPE', 'ROW_COUNT', 'LAST_ALTERED'}
+    sql = f"SELECT TABLE_NAME, TABLE_TYPE, ROW_COUNT, LAST_ALTERED FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = '{schema}'"
+    return _cached(('tables', schema), ttl, lambda: {row['TABLE_NAME']: row for row in fetch_rows(session, sql, query_tag('metadata', ['TABLES'], schema))})
+
+
+def row_counts(session, schema, ttl=catalog_ttl_seconds):
+    return {table: info['ROW_COUNT'] for table, info in table_info(session, schema, ttl).items()}
+
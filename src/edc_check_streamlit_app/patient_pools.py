@@ -0,0 +1,99 @@
+# Table IB. Every patient gets one bit per pool criterion (a face-to-face encounter in the last 5
+# years, a VITAL record, ...) from one pass over each source table, and the patients are counted
+# per combination of bits. Each IB row is then the sum over the combinations that contain its
+# criteria, and so is any other pool ("diagnosis and lab but no vital") without another query:
+# there are at most 2^8 combinations, however many patients there are.
+from functools import partial
+
+from demographic_summary import format_percentage
+from query_executor import defer, work_item
+from result_store import cached_fetch_rows
+
+
+pool_tables = ['DEMOGRAPHIC', 'ENCOUNTER', 'DIAGNOSIS', 'PROCEDURES', 'VITAL', 'PRESCRIBING', 'MED_ADMIN', 'LAB_RESULT_CM']
+
+face_to_face = "('EI','ED','AV','IP','OS')"
+
+# flag -> (description, [(table, condition)]); {five_years} and {one_year} are the lookback dates.
+# A flag's bit is 1 << its position here.
+patient_flags = {
+    'demographic': ("In the DEMOGRAPHIC table", [('DEMOGRAPHIC', "1 = 1")]),
+    'enc_f2f_5y': ("Face-to-face encounter within 5 years", [('ENCOUNTER', f"ADMIT_DATE >= '{{five_years}}' AND ENC_TYPE IN {face_to_face}")]),
+    'enc_f2f_1y': ("Face-to-face encounter within 1 year", [('ENCOUNTER', f"ADMIT_DATE >= '{{one_year}}' AND ENC_TYPE IN {face_to_face}")]),
+    'dx_f2f_5y': ("Face-to-face DIAGNOSIS record within 5 years", [('DIAGNOSIS', f"ADMIT_DATE >= '{{five_years}}' AND ENC_TYPE IN {face_to_face}")]),
+    'vital_5y': ("VITAL record within 5 years", [('VITAL', "MEASURE_DATE >= '{five_years}'")]),
+    'rx_or_medadmin_5y': ("PRESCRIBING or MED_ADMIN record within 5 years", [('PRESCRIBING', "RX_ORDER_DATE >= '{five_years}'"),
+                                                                           ('MED_ADMIN', "MEDADMIN_START_DATE >= '{five_years}'")]),
+    'lab_5y': ("LAB_RESULT_CM record within 5 years", [('LAB_RESULT_CM', "RESULT_DATE >= '{five_years}'")]),
+    'px_5y': ("PROCEDURES record within 5 years", [('PROCEDURES', "ADMIT_DATE >= '{five_years}'")]),
+}
+
+flag_bits = {flag: 1 << position for position, flag in enumerate(patient_flags)}
+
+# IB rows: (metric, description, flags of the pool, denominator flag of the percentage or None)
+pool_rows = [
+    ('All patients', 'Number of unique patients in the DEMOGRAPHIC table', ['demographic'], None),
+    ('Potential pool of patients for observational studies', 'Number of unique patients with at least 1 face-to-face (ED, EI, IP, OS, or AV) encounter within the past 5 years',
+     ['enc_f2f_5y'], 'demographic'),
+    ('Potential pool of patients for trials', 'Number of unique patients with at least 1 face-to-face (ED, EI, IP, OS, or AV) encounter within the past 1 year',
+     ['enc_f2f_1y'], 'demographic'),
+    ('Potential pool of patients for studies requiring data on diagnoses, vital measures and (a) medications or (b) medications and lab results',
+     'Number of unique patients with at least 1 DIAGNOSIS record in a face-to-face setting and at least 1 VITAL record within the past 5 years',
+     ['dx_f2f_5y', 'vital_5y'], 'enc_f2f_5y'),
+    ('', 'Number of unique patients with at least 1 DIAGNOSIS record in a face-to-face setting, at least 1 VITAL record, and at least 1 PRESCRIBING or MED_ADMIN record within the past 5 years',
+     ['dx_f2f_5y', 'vital_5y', 'rx_or_medadmin_5y'], 'enc_f2f_5y'),
+    ('', 'Number of unique patients with at least 1 DIAGNOSIS record in a face-to-face setting, at least 1 VITAL record, at least 1 PRESCRIBING or MED_ADMIN record, and at least 1 LAB_RESULT_CM record within the past 5 years',
+     ['dx_f2f_5y', 'vital_5y', 'rx_or_medadmin_5y', 'lab_5y'], 'enc_f2f_5y'),
+    ('Patients with diagnosis data', 'Percentage of patients with encounters who have at least 1 diagnosis', ['enc_f2f_5y', 'dx_f2f_5y'], 'enc_f2f_5y'),
+    ('Patients with procedure data', 'Percentage of patients with encounters who have at least 1 procedure', ['enc_f2f_5y', 'px_5y'], 'enc_f2f_5y'),
+]
+
+
+def flag_counts_sql(current_schema, filter_date, year_1):
+    # patients per combination of flags; one grouped pass per source table
+    conditions = {}
+    for flag, (_, sources) in patient_flags.items():
+        for table, condition in sources:
+            conditions.setdefault(table, []).append((flag_bits[flag], condition.format(five_years=filter_date, one_year=year_1)))
+    branches = []
+    for table, table_conditions in conditions.items():
+        flags = " + ".join(f"MAX(CASE WHEN {condition} THEN {bit} ELSE 0 END)" for bit, condition in table_conditions)
+        where = " OR ".join(f"({condition})" for _, condition in table_conditions)
+        branches.append(f"SELECT PATID, {flags} AS FLAGS FROM {current_schema}.{table} WHERE PATID IS NOT NULL AND ({where}) GROUP BY PATID")
+    union = "\n            UNION ALL\n            ".join(branches)
+    return f"""SELECT FLAGS, COUNT(*) AS PATIENTS
+        FROM (SELECT PATID, BITOR_AGG(FLAGS) AS FLAGS FROM (
+            {union}) table_flags GROUP BY PATID) patient_flags
+        GROUP BY FLAGS"""
+
+
+def pool_size(flag_counts, required, excluded=()):
+    # patients having every required flag and none of the excluded ones
+    required_bits = sum(flag_bits[flag] for flag in required)
+    excluded_bits = sum(flag_bits[flag] for flag in excluded)
+    return sum(row['PATIENTS'] for row in flag_counts
+               if row['FLAGS'] & required_bits == required_bits and not row['FLAGS'] & excluded_bits)
+
+
+def potential_pools_rows(flag_counts):
+    rows = []
+    for row_order, (metric, description, flags, denominator) in enumerate(pool_rows, 1):
+        result = pool_size(flag_counts, flags)
+        rows.append({
+            "METRIC": metric,
+            "METRIC_DESCRIPTION": description,
+            "RESULT": str(result),
+            "ROW_ORDER": row_order,
+            "PERCENTAGE": format_percentage(result, pool_size(flag_counts, [denominator])) if denominator else '',
+        })
+    return rows
+
+
+def submit_flag_counts(executor, session, current_schema, filter_date, year_1, store=None):
+    call = partial(cached_fetch_rows, store, session, current_schema, 'IB', pool_tables, flag_counts_sql(current_schema, filter_date, year_1))
+    return defer(executor, [call], lambda results: results[0], [work_item('IB', current_schema, pool_tables)])
+
+
+def submit_potential_pools(executor, session, current_schema, filter_date, year_1, store=None):
+    flag_counts = submit_flag_counts(executor, session, current_schema, filter_date, year_1, store)
+    return flag_counts._replace(build=lambda results: potential_pools_rows(flag_counts.build(results)))
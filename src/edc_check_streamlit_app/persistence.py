@@ -0,0 +1,204 @@
+# CDM data persistence (Tables VA-VC): the same profile is computed for the current and the
+# previous refresh and the two are compared client-side.
+import math
+from functools import partial
+
+from check_registry import (table_dict, enc_dict, encounter_type_tables, code_type_dict, decrease_threshold,
+                            cutoff_filter, table_change_metrics, percent_change)
+from hll_sketch import error_sigmas, relative_standard_error, window_counts
+from query_executor import Deferred, Work, defer, work_item
+from query_planner import submit_metrics
+from result_store import cached_fetch_rows
+
+
+def table_change_rows(metric_values, current_schema, last_schema, approximate=False):
+    # Table VA
+    rows = []
+    for table in table_dict:
+        previous_record = metric_values[('4.01', last_schema, 'records', table)]
+        current_record = metric_values[('4.01', current_schema, 'records', table)]
+        previous_patients = metric_values.get(('4.01', last_schema, 'patients', table), 0)
+        current_patients = metric_values.get(('4.01', current_schema, 'patients', table), 0)
+        row = {
+            "TABLE_NAME": table,
+            "PREVIOUS_RECORD": previous_record,
+            "CURRENT_RECORD": current_record,
+            "RECORD_CHANGE": percent_change(previous_record, current_record),
+            "PREVIOUS_PATIENTS": previous_patients,
+            "CURRENT_PATIENTS": current_patients,
+            "PATIENT_CHANGE": percent_change(previous_patients, current_patients)
+        }
+        if approximate:
+            row["PATIENT_COUNTS"] = metric_values.get(('4.01', 'patient_counts', table), 'exact')
+        rows.append(row)
+    return rows
+
+
+def change_bounds(previous, previous_precision, current, current_precision):
+    # percent change +/- error_sigmas standard errors of the ratio of two independent estimates
+    change = percent_change(previous, current)
+    if change is None:
+        return None
+    variance = sum(relative_standard_error(precision) ** 2 for precision in (previous_precision, current_precision) if precision)
+    margin = error_sigmas * math.sqrt(variance) * current / previous * 100
+    return change - margin, change + margin
+
+
+def exact_patients(session, schema, table, cutoff_date, store=None):
+    sql = f"SELECT COUNT(DISTINCT PATID) AS PATIENTS FROM {schema}.{table} WHERE {cutoff_filter(table, cutoff_date)}"
+    return cached_fetch_rows(store, session, schema, '4.01', [table], sql)[0]['PATIENTS']
+
+
+def approximate_table_change(session, current_schema, last_schema, table, cutoff_date, store=None):
+    # records from the monthly sketch rows, patients from merged sketches; falls back to exact
+    # distinct counts when the estimated change could lie on either side of the threshold
+    values = {}
+    precisions = {}
+    for schema in (current_schema, last_schema):
+        records, patients, precisions[schema] = window_counts(session, schema, table, cutoff_date, store)
+        values[('4.01', schema, 'records', table)] = records
+        values[('4.01', schema, 'patients', table)] = patients
+    bounds = change_bounds(values[('4.01', last_schema, 'patients', table)], precisions[last_schema],
+                           values[('4.01', current_schema, 'patients', table)], precisions[current_schema])
+    if bounds is not None and bounds[0] <= decrease_threshold <= bounds[1]:
+        for schema in (current_schema, last_schema):
+            values[('4.01', schema, 'patients', table)] = exact_patients(session, schema, table, cutoff_date, store)
+        values[('4.01', 'patient_counts', table)] = 'exact (near threshold)'
+    elif precisions[current_schema] or precisions[last_schema]:
+        error = error_sigmas * relative_standard_error(precisions[current_schema] or precisions[last_schema]) * 100
+        values[('4.01', 'patient_counts', table)] = f"estimate ±{error:.1f}%"
+    return values
+
+
+def submit_table_changes(executor, session, current_schema, last_schema, cutoff_date, store=None, approximate=False):
+    # the monthly sketches scan and group the whole table, which only pays off once they are
+    # stored; without a store the exact windowed count is cheaper
+    if not approximate or store is None:
+        metrics = table_change_metrics(current_schema, cutoff_date) + table_change_metrics(last_schema, cutoff_date)
+        planned = submit_metrics(executor, session, metrics, store)
+        return Deferred(planned.futures, lambda results: table_change_rows(planned.build(results), current_schema, last_schema))
+
+    # undated tables have no window to sketch and stay on the exact planner pass
+    undated = [table for table in table_dict if not table_dict[table]]
+    metrics = table_change_metrics(current_schema, cutoff_date, undated) + table_change_metrics(last_schema, cutoff_date, undated)
+    planned = submit_metrics(executor, session, metrics, store)
+    dated = [table for table in table_dict if table_dict[table]]
+    sketched = defer(executor, [partial(approximate_table_change, session, current_schema, last_schema, table, cutoff_date, store) for table in dated],
+                     lambda results: results, [Work(None, [(current_schema, table), (last_schema, table)]) for table in dated])
+
+    def build(results):
+        values = planned.build(results[:len(planned.futures)])
+        for table_values in results[len(planned.futures):]:
+            values.update(table_values)
+        return table_change_rows(values, current_schema, last_schema, approximate=True)
+
+    return Deferred(planned.futures + sketched.futures, build)
+
+
+def encounter_type_sql(schema, table, cutoff_date):
+    # Table VB: every encounter type comes out of one grouped pass (and one ENCOUNTER join) per table
+    col = table_dict[table]
+    enc_types = ", ".join(f"'{enc_type}'" for enc_type in enc_dict)
+    if encounter_type_tables[table]:
+        return f"""SELECT '{table}' AS TABLE_NAME, e.ENC_TYPE, COUNT(*) AS RECORDS, COUNT(DISTINCT t.PATID) AS PATIENTS
+            FROM {schema}.{table} t JOIN {schema}.encounter e ON t.ENCOUNTERID = e.ENCOUNTERID AND t.PATID = e.PATID
+            WHERE t.{col} >= '{cutoff_date}' AND e.ADMIT_DATE >= '{cutoff_date}' AND e.ENC_TYPE IN ({enc_types})
+            GROUP BY e.ENC_TYPE"""
+    return f"""SELECT '{table}' AS TABLE_NAME, ENC_TYPE, COUNT(*) AS RECORDS, COUNT(DISTINCT PATID) AS PATIENTS
+            FROM {schema}.{table}
+            WHERE {col} >= '{cutoff_date}' AND ENC_TYPE IN ({enc_types})
+            GROUP BY ENC_TYPE"""
+
+
+def encounter_type_counts(rows):
+    counts = {}
+    for row in rows:
+        counts[(row['TABLE_NAME'], row['ENC_TYPE'])] = (row['RECORDS'], row['PATIENTS'])
+    return counts
+
+
+def encounter_type_change_tables(previous_counts, current_counts):
+    # one rendered table per encounter type, first column named after the encounter type
+    tables = {}
+    for enc_type, enc in enc_dict.items():
+        rows = []
+        for table in encounter_type_tables:
+            previous_record, previous_patients = previous_counts.get((table, enc_type), (0, 0))
+            current_record, current_patients = current_counts.get((table, enc_type), (0, 0))
+            rows.append({
+                enc: table,
+                "PREVIOUS_RECORD": previous_record,
+                "CURRENT_RECORD": current_record,
+                "RECORD_CHANGE": percent_change(previous_record, current_record),
+                "PREVIOUS_PATIENTS": previous_patients,
+                "CURRENT_PATIENTS": current_patients,
+                "PATIENT_CHANGE": percent_change(previous_patients, current_patients)
+            })
+        tables[enc_type] = rows
+    return tables
+
+
+def encounter_type_inputs(table):
+    return [table, 'ENCOUNTER'] if encounter_type_tables[table] else [table]
+
+
+def submit_encounter_type_changes(executor, session, current_schema, last_schema, cutoff_date, store=None):
+    calls = []
+    work = []
+    for table in encounter_type_tables:
+        for schema in (current_schema, last_schema):
+            calls.append(partial(cached_fetch_rows, store, session, schema, '4.02', encounter_type_inputs(table), encounter_type_sql(schema, table, cutoff_date)))
+            work.append(work_item('4.02', schema, encounter_type_inputs(table)))
+
+    def build(results):
+        current = [row for rows in results[0::2] for row in rows]
+        previous = [row for rows in results[1::2] for row in rows]
+        return encounter_type_change_tables(encounter_type_counts(previous), encounter_type_counts(current))
+
+    return defer(executor, calls, build, work)
+
+
+def code_type_sql(schema, cutoff_date):
+    # Table VC: one grouped pass per table gives record and distinct-code counts for every code type
+    branches = []
+    for table, (date_col, type_col, code_col, code_types) in code_type_dict.items():
+        where = f"{date_col} >= '{cutoff_date}' AND {code_col} IS NOT NULL"
+        if type_col.startswith("'"):
+            branches.append(f"SELECT '{table}' AS TABLE_NAME, {type_col} AS CODE, COUNT(*) AS RECORDS, COUNT(DISTINCT {code_col}) AS DISTINCT_CODES FROM {schema}.{table} WHERE {where}")
+        else:
+            type_list = ", ".join(f"'{code_type}'" for code_type in code_types)
+            branches.append(f"SELECT '{table}' AS TABLE_NAME, {type_col} AS CODE, COUNT(*) AS RECORDS, COUNT(DISTINCT {code_col}) AS DISTINCT_CODES FROM {schema}.{table} WHERE {where} AND {type_col} IN ({type_list}) GROUP BY {type_col}")
+    return "\nUNION ALL\n".join(branches)
+
+
+def code_type_counts(rows):
+    counts = {}
+    for row in rows:
+        counts[(row['TABLE_NAME'], row['CODE'])] = (row['RECORDS'], row['DISTINCT_CODES'])
+    return counts
+
+
+def code_type_change_rows(previous_counts, current_counts):
+    rows = []
+    for table in sorted(code_type_dict):
+        for code in sorted(code_type_dict[table][3]):
+            previous_record, previous_codes = previous_counts.get((table, code), (0, 0))
+            current_record, current_codes = current_counts.get((table, code), (0, 0))
+            rows.append({
+                "TABLE_NAME": table,
+                "CODE": code,
+                "PREVIOUS_RECORD": previous_record,
+                "CURRENT_RECORD": current_record,
+                "RECORD_CHANGE": percent_change(previous_record, current_record),
+                "PREVIOUS_DISTINCT_CODES": previous_codes,
+                "CURRENT_DISTINCT_CODES": current_codes,
+                "DISTINCT_CODES_CHANGE": percent_change(previous_codes, current_codes)
+            })
+    return rows
+
+
+def submit_code_type_changes(executor, session, current_schema, last_schema, cutoff_date, store=None):
+    calls = [partial(cached_fetch_rows, store, session, schema, '4.03', list(code_type_dict), code_type_sql(schema, cutoff_date))
+             for schema in (current_schema, last_schema)]
+    return defer(executor, calls, lambda results: code_type_change_rows(code_type_counts(results[1]), code_type_counts(results[0])),
+                 [work_item('4.03', schema, list(code_type_dict)) for schema in (current_schema, last_schema)])
@@ -0,0 +1,215 @@
+# Concurrent execution of independent checks. Every check is split into calls that each send
+# their own statements; the calls of a whole report section are submitted at once to a bounded
+# thread pool and each check is rendered into its own placeholder as soon as its calls complete.
+#
+# Submitted calls are held until the section starts waiting on them and are then dispatched
+# longest-estimated first, which keeps the pool busy until the end instead of leaving one big
+# check running alone (see check_scheduler for the estimates and the warehouse routing).
+#
+# A run that leaves the executor's block by an exception (a Streamlit rerun raises one into the
+# script while it waits) abandons its calls: held ones are dropped and the statements of running
+# ones are cancelled on the warehouse instead of running on unread.
+import itertools
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from query_profiler import query_tag
+
+
+default_max_concurrency = 8
+
+# futures of the calls a check needs and how to build its result from their values;
+# build always runs on the caller's thread so it may render
+Deferred = namedtuple('Deferred', ['futures', 'build'])
+
+# what a call reads, for cost estimates: the QUERY_TAG its statement carries (None when it sends
+# several) and the (schema, table) pairs it scans
+Work = namedtuple('Work', ['tag', 'inputs'])
+
+# a call as it will be dispatched: estimated seconds and the warehouse tier it runs on
+ScheduledCall = namedtuple('ScheduledCall', ['work', 'seconds', 'warehouse'])
+
+default_warehouse = 'light'
+
+_routing = threading.local()
+
+
+def current_warehouse():
+    # warehouse tier of the call running on this thread
+    return getattr(_routing, 'warehouse', default_warehouse)
+
+
+class ScheduledExecutor:
+    # estimate(work) -> (seconds, warehouse); without one, calls keep their submission order
+
+    def __init__(self, max_concurrency=default_max_concurrency, estimate=None):
+        self.max_concurrency = max_concurrency
+        self._estimate = estimate
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='edc-check')
+        self._pending = []
+        self._started = False
+        self._abandoned = False
+        self._futures = []
+        # statement id -> cancel() of the statements the running calls wait on
+        self._statements = {}
+        self._statement_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, call, work=None):
+        future = Future()
+        future.scheduler = self
+        with self._lock:
+            if self._abandoned:
+                future.cancel()
+                return future
+            self._futures.append(future)
+            if self._started:
+                self._dispatch(call, future, self._scheduled(work))
+            else:
+                self._pending.append((call, future, work))
+        return future
+
+    def _scheduled(self, work):
+        if self._estimate is None or work is None:
+            return ScheduledCall(work, 0.0, default_warehouse)
+        return ScheduledCall(work, *self._estimate(work))
+
+    def _ordered(self):
+        # longest first; sorted() is stable, so ties and unestimated calls keep submission order
+        scheduled = [(call, future, self._scheduled(work)) for call, future, work in self._pending]
+        return sorted(scheduled, key=lambda item: -item[2].seconds)
+
+    def schedule(self):
+        # the calls held so far in dispatch order, without running them
+        with self._lock:
+            return [scheduled for _, _, scheduled in self._ordered()]
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            ordered = self._ordered()
+            self._pending = []
+            for call, future, scheduled in ordered:
+                self._dispatch(call, future, scheduled)
+
+    def cancel(self):
+        # dry run: drop the held calls; their futures report cancelled
+        with self._lock:
+            self._started = True
+            for _, future, _ in self._pending:
+                future.cancel()
+            self._pending = []
+
+    def abandon(self):
+        # nobody will read the results: drop held and queued calls and cancel the statements of
+        # running ones; returns how many statements were cancelled
+        with self._lock:
+            self._abandoned = True
+            self._started = True
+            self._pending = []
+            for future in self._futures:
+                future.cancel()
+            cancels = list(self._statements.values())
+        for cancel in cancels:
+            try:
+                cancel()
+            except Exception:
+                pass  # the statement finished or its session is gone
+        return len(cancels)
+
+    def _track(self, cancel):
+        with self._lock:
+            if not self._abandoned:
+                statement_id = next(self._statement_ids)
+                self._statements[statement_id] = cancel
+                return statement_id
+        cancel()
+        return None
+
+    def _untrack(self, statement_id):
+        with self._lock:
+            self._statements.pop(statement_id, None)
+
+    def _dispatch(self, call, future, scheduled):
+        self._pool.submit(self._run, call, future, scheduled.warehouse)
+
+    def _run(self, call, future, warehouse):
+        if not future.set_running_or_notify_cancel():
+            return
+        _routing.warehouse = warehouse
+        _routing.executor = self
+        try:
+            future.set_result(call())
+        except BaseException as error:
+            future.set_exception(error)
+        finally:
+            _routing.warehouse = default_warehouse
+            _routing.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.start()
+        else:
+            self.abandon()
+        self._pool.shutdown(wait=True)
+        return False
+
+
+@contextmanager
+def cancellable(cancel):
+    # while the calling check waits on a statement, cancel() stops it if the run is abandoned;
+    # outside an executor (drill-downs, the metadata catalog) nothing is tracked
+    executor = getattr(_routing, 'executor', None)
+    if executor is None:
+        yield
+        return
+    statement_id = executor._track(cancel)
+    try:
+        yield
+    finally:
+        executor._untrack(statement_id)
+
+
+def make_executor(max_concurrency=default_max_concurrency, estimate=None):
+    return ScheduledExecutor(max_concurrency, estimate)
+
+
+def work_item(check_id, schema, tables):
+    # Work of a call sending one statement tagged like cached_fetch_rows tags it
+    return Work(query_tag(check_id, tables, schema), [(schema, table) for table in tables])
+
+
+def defer(executor, calls, build, work=None):
+    work = work or [None] * len(calls)
+    return Deferred([executor.submit(call, item) for call, item in zip(calls, work)], build)
+
+
+def _start(futures):
+    # the first wait on a section's calls releases them all, largest first
+    for scheduler in {getattr(future, 'scheduler', None) for future in futures} - {None}:
+        scheduler.start()
+
+
+def is_done(deferred):
+    _start(deferred.futures)
+    return all(future.done() for future in deferred.futures)
+
+
+def resolve(deferred):
+    _start(deferred.futures)
+    return deferred.build([future.result() for future in deferred.futures])
+
+
+def wait_any(deferreds, timeout):
+    # blocks until one more call of the given checks completes or the timeout passes
+    futures = [future for deferred in deferreds for future in deferred.futures if not future.done()]
+    _start(futures)
+    if futures:
+        wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
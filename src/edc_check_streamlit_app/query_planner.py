@@ -0,0 +1,145 @@
+# Scan-sharing planner: every metric requested by the checks of a report run is grouped by
+# its base table and answered by a single conditional-aggregation query per table.
+import threading
+from collections import namedtuple
+from functools import partial
+
+from count_provider import metadata_row_count
+from key_sets import key_set_dict, inline_key_set, materialize_key_sets
+from query_executor import Work, defer, current_warehouse
+from query_profiler import query_tag
+from result_store import cached_rows
+from warehouse import fetch_rows
+
+
+# key: any hashable used by the check to look its value up again
+# agg: 'count' or 'count_distinct'
+# expr: column/expression for count_distinct, '' for count
+# where: optional predicate restricting the rows the metric looks at
+# missing_from: key set name; only rows whose expr is absent from that key set are counted
+Metric = namedtuple('Metric', ['key', 'schema', 'table', 'agg', 'expr', 'where', 'missing_from'], defaults=(None,))
+
+# one statement per (schema, table) and the metric keys answered by each alias
+PlannedQuery = namedtuple('PlannedQuery', ['schema', 'table', 'sql', 'aliases'])
+
+
+def aggregate_sql(agg, expr, where):
+    if agg == 'count':
+        return f"COUNT_IF({where})" if where else "COUNT(*)"
+    if agg == 'count_distinct':
+        return f"COUNT(DISTINCT CASE WHEN {where} THEN {expr} END)" if where else f"COUNT(DISTINCT {expr})"
+    raise ValueError(f"Unknown aggregate '{agg}'")
+
+
+def plan_metrics(metrics, key_sets=None):
+    key_sets = key_sets or {}
+    tables = {}
+    for metric in metrics:
+        tables.setdefault((metric.schema, metric.table), []).append(metric)
+
+    planned = []
+    for (schema, table), table_metrics in tables.items():
+        # a filter shared by every metric of the table goes to the WHERE clause so it can prune
+        filters = {metric.where for metric in table_metrics}
+        hoisted = filters.pop() if len(filters) == 1 else ''
+
+        # one hash anti-join per (key set, child column); key sets are distinct so rows never fan out
+        joins = {}
+        for metric in table_metrics:
+            if metric.missing_from and (metric.missing_from, metric.expr) not in joins:
+                joins[(metric.missing_from, metric.expr)] = f"K{len(joins)}"
+
+        columns = {}
+        aliases = {}
+        for metric in table_metrics:
+            where = '' if hoisted else metric.where
+            if metric.missing_from:
+                missing = f"{joins[(metric.missing_from, metric.expr)]}.KEY_VALUE IS NULL"
+                where = f"{missing} AND ({where})" if where else missing
+            column = aggregate_sql(metric.agg, metric.expr, where)
+            if column not in columns:
+                columns[column] = f"M{len(columns)}"
+            aliases.setdefault(columns[column], []).append(metric.key)
+
+        select = ", ".join(f"{column} AS {alias}" for column, alias in columns.items())
+        sql = f"SELECT {select} FROM {schema}.{table} T"
+        for (name, expr), join_alias in joins.items():
+            relation = key_sets.get((schema, name)) or inline_key_set(schema, name)
+            sql += f" LEFT JOIN {relation} {join_alias} ON {join_alias}.KEY_VALUE = T.{expr}"
+        if hoisted:
+            sql += f" WHERE {hoisted}"
+        planned.append(PlannedQuery(schema, table, sql, aliases))
+    return planned
+
+
+def decode_results(planned_query, rows):
+    values = {}
+    row = rows[0]
+    for alias, keys in planned_query.aliases.items():
+        for key in keys:
+            values[key] = row[alias]
+    return values
+
+
+def input_tables(table_metrics):
+    tables = {metric.table for metric in table_metrics}
+    tables.update(key_set_dict[metric.missing_from][0] for metric in table_metrics if metric.missing_from)
+    return sorted(tables)
+
+
+def check_tag(table_metrics):
+    # a shared pass is tagged with every check it serves, e.g. 1.05+1.08+1.09
+    return '+'.join(sorted({str(metric.key[0]) for metric in table_metrics}))
+
+
+def submit_metrics(executor, session, metrics, store=None):
+    # one call per (schema, table); key sets are only materialized for tables that miss the store.
+    # Temporary tables belong to one Snowflake session and a RoutedSession has one per warehouse
+    # tier, so every tier materializes its own: warehouse tier -> {(schema, name): relation}
+    key_sets = {}
+    key_set_lock = threading.Lock()
+
+    def execute(schema, table, table_metrics):
+        names = {metric.missing_from for metric in table_metrics if metric.missing_from}
+        with key_set_lock:
+            tier_key_sets = key_sets.setdefault(current_warehouse(), {})
+            missing = [name for name in names if (schema, name) not in tier_key_sets]
+            if missing:
+                tier_key_sets.update(materialize_key_sets(session, schema, missing))
+        return fetch_rows(session, plan_metrics(table_metrics, tier_key_sets)[0].sql, query_tag(check_tag(table_metrics), [table], schema))
+
+    def table_values(schema, table, table_metrics):
+        values = {}
+        # unfiltered COUNT(*) is answered from metadata; the table is only scanned for what is left
+        row_counts = [metric for metric in table_metrics if metric.agg == 'count' and not metric.where and not metric.missing_from]
+        if row_counts:
+            row_count = metadata_row_count(session, schema, table)
+            if row_count is not None:
+                values.update({metric.key: row_count for metric in row_counts})
+                table_metrics = [metric for metric in table_metrics if metric not in row_counts]
+                if not table_metrics:
+                    return values
+
+        # the inline plan is deterministic, so its SQL doubles as the store key
+        planned_query = plan_metrics(table_metrics)[0]
+        rows = cached_rows(store, session, schema, 'planner', input_tables(table_metrics), planned_query.sql,
+                           lambda: execute(schema, table, table_metrics))
+        values.update(decode_results(planned_query, rows))
+        return values
+
+    tables = {}
+    for metric in metrics:
+        tables.setdefault((metric.schema, metric.table), []).append(metric)
+
+    def build(results):
+        values = {}
+        for result in results:
+            values.update(result)
+        return values
+
+    calls = []
+    work = []
+    for (schema, table), table_metrics in tables.items():
+        calls.append(partial(table_values, schema, table, table_metrics))
+        work.append(Work(query_tag(check_tag(table_metrics), [table], schema), [(schema, name) for name in input_tables(table_metrics)]))
+    return defer(executor, calls, build, work)
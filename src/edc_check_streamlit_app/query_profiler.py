@@ -0,0 +1,199 @@
+# Per-statement profile of the checks. Every statement sent through warehouse.fetch_rows carries
+# a QUERY_TAG naming the check, its input tables and schema (edc:1.11:DIAGNOSIS:CDM_2025Q1) and
+# is logged with its query id, client-side latency and result size. The warehouse side (bytes
+# and partitions scanned, compilation vs execution time) is joined from QUERY_HISTORY on demand,
+# so profiling never adds a statement to the checks themselves.
+import json
+import threading
+import time
+import weakref
+from collections import deque
+from datetime import datetime
+
+
+# statements kept per session; the oldest are dropped first
+query_log_limit = 5000
+
+# characters of SQL text kept per statement
+sql_text_limit = 500
+
+# QUERY_HISTORY column -> profile column
+warehouse_stat_columns = {
+    'BYTES_SCANNED': 'BYTES_SCANNED',
+    'PARTITIONS_SCANNED': 'PARTITIONS_SCANNED',
+    'PARTITIONS_TOTAL': 'PARTITIONS_TOTAL',
+    'COMPILATION_TIME': 'COMPILATION_MS',
+    'EXECUTION_TIME': 'EXECUTION_MS',
+    'QUEUED_OVERLOAD_TIME': 'QUEUED_MS',
+    'TOTAL_ELAPSED_TIME': 'WAREHOUSE_ELAPSED_MS',
+    'WAREHOUSE_NAME': 'WAREHOUSE_NAME',
+    'WAREHOUSE_SIZE': 'WAREHOUSE_SIZE',
+}
+
+profile_columns = ['STARTED_AT', 'QUERY_TAG', 'CHECK_ID', 'TABLES', 'SCHEMA', 'QUERY_ID', 'CLIENT_SECONDS',
+                   'ROWS_RETURNED', 'RESULT_BYTES', 'ERROR'] + list(warehouse_stat_columns.values()) + ['SQL_TEXT']
+
+# session -> its QueryLog, dropped with the session (an id() could be reused by a later session)
+_logs = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def query_tag(check_id, tables=(), schema=None):
+    # edc:<check ids>:<tables>:<schema>, the parts after the check id only when known
+    parts = ['edc', check_id, '+'.join(tables)]
+    if schema:
+        parts.append(schema)
+    return ':'.join(parts).rstrip(':')
+
+
+def parse_tag(tag):
+    # (check id, tables, schema) of a tag written by query_tag; anything else is left blank
+    parts = (tag or '').split(':')
+    if parts[0] != 'edc':
+        return '', '', ''
+    parts += [''] * (4 - len(parts))
+    return parts[1], parts[2], parts[3]
+
+
+class QueryLog:
+
+    def __init__(self, limit=query_log_limit):
+        self._records = deque(maxlen=limit)
+        self._added = 0
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            record['SEQUENCE'] = self._added
+            self._added += 1
+            self._records.append(record)
+
+    def position(self):
+        # records added so far; records(since=position()) later returns only the newer ones
+        with self._lock:
+            return self._added
+
+    def records(self, since=0):
+        with self._lock:
+            return [dict(record) for record in self._records if record['SEQUENCE'] >= since]
+
+    def update(self, query_id, values):
+        with self._lock:
+            for record in self._records:
+                if record['QUERY_ID'] == query_id:
+                    record.update(values)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+
+def query_log(session):
+    # one log per session object; QUERY_HISTORY_BY_SESSION only sees that session's statements
+    with _lock:
+        if session not in _logs:
+            _logs[session] = QueryLog()
+        return _logs[session]
+
+
+def result_bytes(rows):
+    # size of the rows as the result store would serialize them
+    return len(json.dumps(rows, default=str))
+
+
+def record_query(session, sql, tag, query_id, started_at, client_seconds, rows=None, error=None, row_count=None):
+    # streamed statements pass row_count instead of their rows; their result size is not known
+    check_id, tables, schema = parse_tag(tag)
+    query_log(session).add({
+        'STARTED_AT': started_at.isoformat(timespec='milliseconds'),
+        'QUERY_TAG': tag,
+        'CHECK_ID': check_id,
+        'TABLES': tables,
+        'SCHEMA': schema,
+        'QUERY_ID': query_id,
+        'CLIENT_SECONDS': round(client_seconds, 3),
+        'ROWS_RETURNED': row_count if rows is None else len(rows),
+        'RESULT_BYTES': None if rows is None else result_bytes(rows),
+        'ERROR': error,
+        'SQL_TEXT': ' '.join(sql.split())[:sql_text_limit],
+    })
+
+
+def profiled(session, sql, tag, run):
+    # run() executes the statement and returns (query id, rows); failures are logged and re-raised
+    started_at = datetime.now()
+    started = time.perf_counter()
+    try:
+        query_id, rows = run()
+    except Exception as error:
+        record_query(session, sql, tag, getattr(error, 'sfqid', None), started_at, time.perf_counter() - started,
+                     error=f"{type(error).__name__}: {error}")
+        raise
+    record_query(session, sql, tag, query_id, started_at, time.perf_counter() - started, rows)
+    return rows
+
+
+def profiled_stream(session, sql, tag, rows, query_id=None):
+    # passes the rows of an iterator through and logs the statement once it is exhausted or closed
+    started_at = datetime.now()
+    started = time.perf_counter()
+    count = 0
+    error = None
+    try:
+        for row in rows:
+            count += 1
+            yield row
+    except Exception as failure:
+        error = f"{type(failure).__name__}: {failure}"
+        raise
+    finally:
+        record_query(session, sql, tag, query_id, started_at, time.perf_counter() - started, error=error, row_count=count)
+
+
+def warehouse_stats_sql(query_ids):
+    id_list = ', '.join(f"'{query_id}'" for query_id in query_ids)
+    columns = ', '.join(['QUERY_ID'] + list(warehouse_stat_columns))
+    return f"""SELECT {columns} FROM TABLE(INFORMATION_SCHEMA.QUERY_HISTORY_BY_SESSION(RESULT_LIMIT => 10000))
+        WHERE QUERY_ID IN ({id_list})"""
+
+
+def load_warehouse_stats(session, batch_size=1000):
+    # fills the warehouse columns of logged statements that do not have them yet; returns how many
+    # were found. Sent directly so the lookup itself is not logged.
+    log = query_log(session)
+    pending = [record['QUERY_ID'] for record in log.records() if record['QUERY_ID'] and record.get('BYTES_SCANNED') is None]
+    found = 0
+    # a RoutedSession spreads its statements over one session per warehouse
+    for history_session in getattr(session, 'sessions', {None: session}).values():
+        for first in range(0, len(pending), batch_size):
+            for row in history_session.sql(warehouse_stats_sql(pending[first:first + batch_size])).collect():
+                row = row.as_dict()
+                log.update(row['QUERY_ID'], {column: row[name] for name, column in warehouse_stat_columns.items()})
+                found += 1
+    return found
+
+
+def profile_rows(session, since=0):
+    return [{column: record.get(column) for column in profile_columns} for record in query_log(session).records(since)]
+
+
+def check_totals(rows):
+    # per (schema, check): statements, client seconds and bytes scanned, for charge-back
+    totals = {}
+    for row in rows:
+        total = totals.setdefault((row['SCHEMA'], row['CHECK_ID']), {
+            'SCHEMA': row['SCHEMA'], 'CHECK_ID': row['CHECK_ID'], 'STATEMENTS': 0, 'CLIENT_SECONDS': 0.0, 'BYTES_SCANNED': 0})
+        total['STATEMENTS'] += 1
+        total['CLIENT_SECONDS'] = round(total['CLIENT_SECONDS'] + row['CLIENT_SECONDS'], 3)
+        total['BYTES_SCANNED'] += row['BYTES_SCANNED'] or 0
+    return sorted(totals.values(), key=lambda total: total['CLIENT_SECONDS'], reverse=True)
+
+
+def profile_csv(rows):
+    import csv
+    import io
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=profile_columns, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue()
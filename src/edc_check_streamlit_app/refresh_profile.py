@@ -0,0 +1,202 @@
+# Refresh profiles: Tables VA-VC for any cutoff date and any pair of refreshes without scanning
+# either schema again. A refresh is profiled once per table into daily buckets of
+#
+#   RECORDS    rows dated that day
+#   LAST_KEYS  keys (PATID, or the code for 4.03) whose most recent row is dated that day
+#
+# per check (4.01-4.03) and category (ENC_TYPE, code type). Records since a cutoff are the sum of
+# RECORDS from the cutoff on; distinct keys since a cutoff are the keys whose last row is on or
+# after it, the sum of LAST_KEYS from the cutoff on. Both are exact. Profiles live in the result
+# store keyed on the table versions, so a frozen refresh is profiled the first time it is analyzed
+# and every later comparison, cutoff or history is computed client-side from the stored rows.
+import re
+from functools import partial
+
+from check_registry import table_dict, enc_dict, encounter_type_tables, code_type_dict, percent_change
+from persistence import (table_change_rows, encounter_type_change_tables, encounter_type_inputs,
+                         code_type_change_rows)
+from query_executor import defer, work_item
+from result_store import cached_fetch_rows
+
+
+# refreshes shown by the history view
+default_history_length = 10
+
+# the refresh date ending a schema name: CDM_B_2025Q1, CDM_2024_12, CDM20250101
+refresh_date_suffix = re.compile(r'_?\d[\dQ_-]*$', re.I)
+
+
+def profile_branch(kind, table, category, key, day, source, where):
+    # one profiled dimension of a table: per (category, day) the rows and the keys last seen that
+    # day; undated tables put every row in a NULL day, which IS NOT DISTINCT FROM matches
+    return f"""SELECT '{kind}' AS KIND, '{table}' AS TABLE_NAME, CATEGORY, RECORD_DATE, SUM(N) AS RECORDS,
+            SUM(CASE WHEN KEY_VALUE IS NOT NULL AND RECORD_DATE IS NOT DISTINCT FROM LAST_DATE THEN 1 ELSE 0 END) AS LAST_KEYS
+        FROM (SELECT CATEGORY, KEY_VALUE, RECORD_DATE, N, MAX(RECORD_DATE) OVER (PARTITION BY CATEGORY, KEY_VALUE) AS LAST_DATE
+              FROM (SELECT {category} AS CATEGORY, {key} AS KEY_VALUE, {day} AS RECORD_DATE, COUNT(*) AS N
+                    FROM {source} WHERE {where} GROUP BY 1, 2, 3) keyed) last_seen
+        GROUP BY CATEGORY, RECORD_DATE"""
+
+
+def table_profile_sql(schema, table):
+    # 4.01: records and patients of the table
+    col = table_dict[table]
+    key = 'NULL' if table == 'PROVIDER' else 'PATID'
+    if not col:
+        return profile_branch('4.01', table, 'NULL', key, 'CAST(NULL AS DATE)', f"{schema}.{table}", '1 = 1')
+    return profile_branch('4.01', table, 'NULL', key, f"CAST({col} AS DATE)", f"{schema}.{table}", f"{col} IS NOT NULL")
+
+
+def encounter_type_profile_sql(schema, table):
+    # 4.02: a row of a table joined to ENCOUNTER is in the window when both of its dates are,
+    # i.e. when the earlier of the two is
+    col = table_dict[table]
+    enc_types = ", ".join(f"'{enc_type}'" for enc_type in enc_dict)
+    if encounter_type_tables[table]:
+        return profile_branch('4.02', table, 'e.ENC_TYPE', 't.PATID', f"LEAST(CAST(t.{col} AS DATE), CAST(e.ADMIT_DATE AS DATE))",
+                              f"{schema}.{table} t JOIN {schema}.encounter e ON t.ENCOUNTERID = e.ENCOUNTERID AND t.PATID = e.PATID",
+                              f"t.{col} IS NOT NULL AND e.ADMIT_DATE IS NOT NULL AND e.ENC_TYPE IN ({enc_types})")
+    return profile_branch('4.02', table, 'ENC_TYPE', 'PATID', f"CAST({col} AS DATE)", f"{schema}.{table}",
+                          f"{col} IS NOT NULL AND ENC_TYPE IN ({enc_types})")
+
+
+def code_type_profile_sql(schema, table):
+    # 4.03: records and distinct codes per code type
+    date_col, type_col, code_col, code_types = code_type_dict[table]
+    where = f"{date_col} IS NOT NULL AND {code_col} IS NOT NULL"
+    if not type_col.startswith("'"):
+        where += " AND {} IN ({})".format(type_col, ", ".join(f"'{code_type}'" for code_type in code_types))
+    return profile_branch('4.03', table, type_col, code_col, f"CAST({date_col} AS DATE)", f"{schema}.{table}", where)
+
+
+profiled_checks = ('4.01', '4.02', '4.03')
+
+
+def profile_calls(session, schema, store=None, checks=profiled_checks):
+    # (call, work) per profiled table and check; every call is one statement reusable on its own
+    profiled = []
+    if '4.01' in checks:
+        profiled += [(table, [table], table_profile_sql) for table in table_dict]
+    if '4.02' in checks:
+        profiled += [(table, encounter_type_inputs(table), encounter_type_profile_sql) for table in encounter_type_tables]
+    if '4.03' in checks:
+        profiled += [(table, [table], code_type_profile_sql) for table in code_type_dict]
+    return [(partial(cached_fetch_rows, store, session, schema, 'profile', inputs, profile_sql(schema, table)),
+             work_item('profile', schema, inputs)) for table, inputs, profile_sql in profiled]
+
+
+def submit_profiles(executor, session, schemas, store=None, checks=profiled_checks):
+    # Deferred of schema -> profile rows
+    calls = {schema: profile_calls(session, schema, store, checks) for schema in schemas}
+    sizes = [len(calls[schema]) for schema in schemas]
+    flat = [call for schema in schemas for call in calls[schema]]
+
+    def build(results):
+        profiles = {}
+        first = 0
+        for schema, size in zip(schemas, sizes):
+            profiles[schema] = [row for rows in results[first:first + size] for row in rows]
+            first += size
+        return profiles
+
+    return defer(executor, [call for call, _ in flat], build, [work for _, work in flat])
+
+
+def window_totals(profile, cutoff_date):
+    # (check id, table, category) -> [records, distinct keys] on or after cutoff_date
+    cutoff = str(cutoff_date)
+    totals = {}
+    for row in profile:
+        day = row['RECORD_DATE']
+        if day is not None and str(day)[:10] < cutoff:
+            continue
+        total = totals.setdefault((row['KIND'], row['TABLE_NAME'], row['CATEGORY']), [0, 0])
+        total[0] += int(row['RECORDS'])
+        total[1] += int(row['LAST_KEYS'])
+    return totals
+
+
+def table_change_values(schema, totals):
+    # metric values as the 4.01 planner pass would return them
+    values = {}
+    for table in table_dict:
+        records, patients = totals.get(('4.01', table, None), (0, 0))
+        values[('4.01', schema, 'records', table)] = records
+        if table != 'PROVIDER':
+            values[('4.01', schema, 'patients', table)] = patients
+    return values
+
+
+def category_counts(check_id, totals):
+    # (table, category) -> (records, distinct keys), as encounter_type_counts/code_type_counts
+    return {(table, category): tuple(total) for (kind, table, category), total in totals.items() if kind == check_id}
+
+
+def profile_changes(profiles, current_schema, last_schema, cutoff_date):
+    # Tables VA, VB and VC by section id, the same rows the scanning checks return
+    current = window_totals(profiles[current_schema], cutoff_date)
+    previous = window_totals(profiles[last_schema], cutoff_date)
+    values = {**table_change_values(current_schema, current), **table_change_values(last_schema, previous)}
+    return {
+        'VA': table_change_rows(values, current_schema, last_schema),
+        'VB': encounter_type_change_tables(category_counts('4.02', previous), category_counts('4.02', current)),
+        'VC': code_type_change_rows(category_counts('4.03', previous), category_counts('4.03', current)),
+    }
+
+
+def submit_profiled_changes(executor, session, current_schema, last_schema, cutoff_date, store=None):
+    # VA-VC from the profiles of both refreshes; section id -> Deferred sharing the profile calls
+    profiles = submit_profiles(executor, session, [current_schema, last_schema], store)
+
+    def section(section_id):
+        return profiles._replace(build=lambda results: profile_changes(profiles.build(results), current_schema, last_schema, cutoff_date)[section_id])
+
+    return {section_id: section(section_id) for section_id in ('VA', 'VB', 'VC')}
+
+
+def history_rows(profiles, schemas, cutoff_date):
+    # Table VA across many refreshes, oldest first: every table's records and patients in each
+    # refresh and the change from the refresh before it
+    rows = []
+    totals = {schema: window_totals(profiles[schema], cutoff_date) for schema in schemas}
+    for table in table_dict:
+        previous = None
+        for schema in schemas:
+            records, patients = totals[schema].get(('4.01', table, None), (0, 0))
+            rows.append({
+                "TABLE_NAME": table,
+                "SCHEMA": schema,
+                "RECORDS": records,
+                "RECORD_CHANGE": percent_change(previous[0], records) if previous else None,
+                "PATIENTS": patients,
+                "PATIENT_CHANGE": percent_change(previous[1], patients) if previous else None,
+            })
+            previous = (records, patients)
+    return rows
+
+
+def submit_history(executor, session, schemas, cutoff_date, store=None):
+    # only the 4.01 profiles are needed for the history
+    profiles = submit_profiles(executor, session, schemas, store, ['4.01'])
+    return profiles._replace(build=lambda results: history_rows(profiles.build(results), schemas, cutoff_date))
+
+
+def refresh_series(schema):
+    # the datamart a refresh belongs to: its schema name without the refresh date
+    return refresh_date_suffix.sub('', schema)
+
+
+def refresh_order(schemas, created=None):
+    # oldest first by INFORMATION_SCHEMA.SCHEMATA.CREATED (metadata_catalog.schema_created), by
+    # name when a creation time is missing
+    created = created or {}
+    if all(created.get(schema) for schema in schemas):
+        return sorted(schemas, key=lambda schema: (created[schema], schema))
+    return sorted(schemas)
+
+
+def history_schemas(schemas, current_schema, count=default_history_length, created=None):
+    # the `count` refreshes of current_schema's datamart up to it, oldest first
+    series = refresh_series(current_schema)
+    ordered = refresh_order([schema for schema in schemas if refresh_series(schema) == series], created)
+    last = ordered.index(current_schema) + 1
+    return ordered[max(last - count, 0):last]
@@ -0,0 +1,116 @@
+# The full EDC report (IA, IB, IIA, IIE, VA-VC) for one pair of schemas, without Streamlit. Used
+# by batch_runner to check many datamarts headlessly; results come back as plain rows keyed by
+# section id and can be rendered to a standalone HTML page.
+from datetime import date
+from html import escape
+
+from check_registry import enc_dict, years_before, decrease_threshold
+from demographic_summary import submit_demographic_summary
+from html_tables import table_css, table_html, exceeds, below
+from integrity_checks import submit_required_checks
+from patient_pools import submit_potential_pools
+from persistence import submit_table_changes, submit_encounter_type_changes, submit_code_type_changes
+from refresh_profile import submit_profiled_changes
+from check_scheduler import plan_rows
+from query_executor import default_max_concurrency, make_executor, resolve
+
+
+# section id -> (title, style); style is ('generic', red columns, ignored columns, bold columns, red value)
+# or ('change', red columns) as in the app
+report_sections = {
+    'IA': ("Table IA. Demographic Summary", ('generic', [], ['ROW_ORDER'], ['CATEGORY'], '')),
+    'IB': ("Table IB. Potential Pools of Patients", ('generic', [], ['ROW_ORDER'], [], '')),
+    'IIA': ("Table IIA. Primary Key Errors", ('generic', ['Exception to specifications'], [], ['TABLE'], 'Yes')),
+    '1.08': ("1.08: Orphan PATID(S)", ('generic', ['Count'], [], ['TABLE'], 0)),
+    '1.09': ("1.09: Orphan ENCOUNTERIDs", ('generic', ['PERCENTAGE'], [], ['TABLE'], 4.99)),
+    '1.10': ("1.10: Replication errors", ('generic', ['Count'], [], ['TABLE'], 0)),
+    '1.11': ("1.11: Encounters assigned to more than one patient", ('generic', ['PERCENTAGE'], [], ['TABLE'], 4.99)),
+    '1.12': ("1.12: Orphan PROVIDERIDs", ('generic', ['Count'], [], ['TABLE'], 0)),
+    'VA': ("Table VA. Changes in Tables", ('change', ['RECORD_CHANGE', 'PATIENT_CHANGE'])),
+    'VB': ("Table VB. Changes in Selected Encounter Types and Domains", ('change', ['RECORD_CHANGE', 'PATIENT_CHANGE'])),
+    'VC': ("Table VC. Changes in Selected Code Types", ('change', ['RECORD_CHANGE', 'DISTINCT_CODES_CHANGE'])),
+}
+
+
+def submit_report(executor, session, current_schema, last_schema, cutoff_date, store=None, approximate=False, today=None, profiles=False):
+    # cutoff_date is the date picked in the app; the checks look back 10 years from it. profiles
+    # computes VA-VC from the refresh profiles instead of scanning both schemas
+    today = today or date.today()
+    lookback = years_before(cutoff_date, 10)
+    checks = submit_required_checks(executor, session, current_schema, lookback, store)
+    if profiles:
+        changes = submit_profiled_changes(executor, session, current_schema, last_schema, lookback, store)
+    else:
+        changes = {
+            'VA': submit_table_changes(executor, session, current_schema, last_schema, lookback, store, approximate),
+            'VB': submit_encounter_type_changes(executor, session, current_schema, last_schema, lookback, store),
+            'VC': submit_code_type_changes(executor, session, current_schema, last_schema, lookback, store),
+        }
+    return {
+        'IA': submit_demographic_summary(executor, session, current_schema, store, today),
+        'IB': submit_potential_pools(executor, session, current_schema, years_before(today, 5).isoformat(), years_before(today, 1).isoformat(), store),
+        'IIA': checks['1.05'],
+        '1.08': checks['1.08'],
+        '1.09': checks['1.09'],
+        '1.10': checks['1.10'],
+        '1.11': checks['1.11'],
+        '1.12': checks['1.12'],
+        **changes,
+    }
+
+
+def run_report(session, current_schema, last_schema, cutoff_date, store=None, approximate=False, max_concurrency=default_max_concurrency, estimate=None,
+               profiles=False):
+    # (results, errors) by section id; a failing section does not stop the others
+    results = {}
+    errors = {}
+    with make_executor(max_concurrency, estimate) as executor:
+        for section, deferred in submit_report(executor, session, current_schema, last_schema, cutoff_date, store, approximate, profiles=profiles).items():
+            try:
+                results[section] = resolve(deferred)
+            except Exception as error:
+                errors[section] = f"{type(error).__name__}: {error}"
+    return results, errors
+
+
+def plan_report(session, current_schema, last_schema, cutoff_date, store=None, approximate=False, max_concurrency=default_max_concurrency, estimate=None,
+                profiles=False):
+    # dry run: the calls of the report in dispatch order with their estimates, none of them sent
+    with make_executor(max_concurrency, estimate) as executor:
+        submit_report(executor, session, current_schema, last_schema, cutoff_date, store, approximate, profiles=profiles)
+        rows = plan_rows(executor.schedule(), max_concurrency)
+        executor.cancel()
+    return rows
+
+
+def section_tables(section, result):
+    # (caption, rows) pairs; VB holds one table per encounter type
+    if section == 'VB':
+        return [(enc_dict[enc_type], result[enc_type]) for enc_type in enc_dict]
+    return [('', result)]
+
+
+def section_html(section, result):
+    style = report_sections[section][1]
+    parts = []
+    for caption, rows in section_tables(section, result):
+        if caption:
+            parts.append(f"<h5>{caption}</h5>")
+        if style[0] == 'change':
+            parts.append(table_html(rows, style[1], below(decrease_threshold), css_class='edc-table edc-change'))
+        else:
+            _, red_columns, ignore_columns, bold_columns, red_value = style
+            parts.append(table_html(rows, red_columns, exceeds(red_value), bold_columns, ignore_columns))
+    return ''.join(parts)
+
+
+def report_html(current_schema, last_schema, cutoff_date, results, errors):
+    body = [f"<h2>CDM HEALTH: {current_schema}</h2>",
+            f"<p>Previous schema: {last_schema}. Cutoff date: {cutoff_date}.</p>"]
+    for section, (title, _) in report_sections.items():
+        body.append(f"<h4>{title}</h4>")
+        if section in errors:
+            body.append(f'<p style="color:red;">This check failed: {escape(errors[section])}</p>')
+        elif section in results:
+            body.append(section_html(section, results[section]))
+    return f"<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>{current_schema}</title>{table_css}</head><body>{''.join(body)}</body></html>"
@@ -0,0 +1,102 @@
+# Persistent store of check results keyed on (schema, check id, parameters). An entry is only
+# reused while INFORMATION_SCHEMA.TABLES reports the same LAST_ALTERED/ROW_COUNT for every input
+# table of the check, so frozen refreshes are never re-billed. A local SQLite file stands in for
+# a Snowflake results table.
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import date, datetime
+from decimal import Decimal
+
+from metadata_catalog import table_info
+from query_profiler import query_tag
+from warehouse import fetch_rows
+
+
+default_store_path = os.environ.get('EDC_RESULT_STORE', os.path.join(tempfile.gettempdir(), 'edc_check_results.sqlite'))
+
+# table versions are re-read at most this often per schema
+versions_ttl_seconds = 60
+
+_stores = {}
+_lock = threading.Lock()
+
+
+def open_store(path=None):
+    path = path or default_store_path
+    with _lock:
+        if path not in _stores:
+            conn = sqlite3.connect(path, check_same_thread=False)
+            conn.execute("""CREATE TABLE IF NOT EXISTS check_results (
+                                schema_name TEXT, check_id TEXT, params TEXT, input_version TEXT,
+                                rows TEXT, stored_at REAL,
+                                PRIMARY KEY (schema_name, check_id, params))""")
+            conn.commit()
+            _stores[path] = conn
+        return _stores[path]
+
+
+def table_versions(session, schema):
+    info = table_info(session, schema, ttl=versions_ttl_seconds)
+    return {table: f"{row['LAST_ALTERED']}|{row['ROW_COUNT']}" for table, row in info.items()}
+
+
+def input_version(session, schema, tables):
+    versions = table_versions(session, schema)
+    return json.dumps([(table, versions.get(table.upper())) for table in sorted(set(tables))])
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def load_result(store, schema, check_id, params, version):
+    with _lock:
+        found = store.execute("SELECT input_version, rows FROM check_results WHERE schema_name = ? AND check_id = ? AND params = ?",
+                              (schema, check_id, params)).fetchone()
+    if found is None or found[0] != version:
+        return None
+    return json.loads(found[1])
+
+
+def save_result(store, schema, check_id, params, version, rows):
+    serialized = json.dumps(rows, default=_json_default)
+    with _lock:
+        store.execute("INSERT OR REPLACE INTO check_results VALUES (?, ?, ?, ?, ?, ?)",
+                      (schema, check_id, params, version, serialized, time.time()))
+        store.commit()
+    # hand back what a later cache hit would return so both paths see the same types
+    return json.loads(serialized)
+
+
+def clear_store(store, schema=None):
+    with _lock:
+        if schema is None:
+            store.execute("DELETE FROM check_results")
+        else:
+            store.execute("DELETE FROM check_results WHERE schema_name = ?", (schema,))
+        store.commit()
+
+
+def cached_rows(store, session, schema, check_id, tables, params, compute):
+    # tables: every CDM table of `schema` the result depends on; params: anything else it depends on
+    if store is None:
+        return compute()
+    params = hashlib.sha1(params.encode()).hexdigest()
+    version = input_version(session, schema, tables)
+    rows = load_result(store, schema, check_id, params, version)
+    if rows is None:
+        rows = save_result(store, schema, check_id, params, version, compute())
+    return rows
+
+
+def cached_fetch_rows(store, session, schema, check_id, tables, sql):
+    return cached_rows(store, session, schema, check_id, tables, sql, lambda: fetch_rows(session, sql, query_tag(check_id, tables, schema)))
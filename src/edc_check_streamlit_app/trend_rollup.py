@@ -0,0 +1,143 @@
+# Trend explorer. Each (schema, table) is rolled up once per year into daily, monthly and yearly
+# record and distinct-patient counts with a single GROUPING SETS scan; switching the grouping or
+# moving the date range inside already fetched years is answered locally from that rollup. The
+# overview counts records per period of every dated table in one UNION ALL statement and marks the
+# periods that drop sharply, so a refresh is checked for gaps without exploring each table.
+from datetime import date, timedelta
+
+from check_registry import table_dict
+from query_profiler import query_tag
+from warehouse import fetch_rows
+
+
+# DISTRIBUTION BY option -> (rollup grain, pandas period start frequency)
+grain_dict = {
+    'YEARLY': ('YEAR', 'YS'),
+    'MONTHLY': ('MONTH', 'MS'),
+    'DAILY': ('DAY', 'D'),
+}
+
+
+# a period is marked when its records fall this many percent below the median of the periods before it
+sharp_drop_threshold = -50
+
+# periods before a period that its baseline median is taken over
+drop_baseline_periods = 6
+
+overview_tables = [table for table in table_dict if table_dict[table]]
+
+
+def overview_sql(schema, start_date, end_date, grain='MONTH'):
+    # records per (table, period) of every dated table; a few thousand rows come back in one result.
+    # The end is exclusive on the next day so timestamps later on end_date are kept
+    branches = "\n        UNION ALL\n        ".join(
+        f"""SELECT '{table}' AS TABLE_NAME, DATE_TRUNC('{grain}', {table_dict[table]})::DATE AS PERIOD, COUNT(*) AS RECORDS
+        FROM {schema}.{table} WHERE {table_dict[table]} >= '{start_date}' AND {table_dict[table]} < '{end_date + timedelta(days=1)}' GROUP BY 2"""
+        for table in overview_tables)
+    return f"""
+        {branches}
+        ORDER BY TABLE_NAME, PERIOD
+    """
+
+
+def fetch_overview(session, schema, start_date, end_date, group_by='MONTHLY'):
+    start_date, end_date = snap_to_periods(start_date, end_date, group_by)
+    return fetch_rows(session, overview_sql(schema, start_date, end_date, grain_dict[group_by][0]),
+                      query_tag('trend', overview_tables, schema))
+
+
+def overview_frames(overview_rows, group_by, start_date, end_date, today=None):
+    # table -> (frame indexed by period with RECORDS and SHARP_DROP columns, marked periods). The
+    # records of a marked period are charted as SHARP_DROP; periods without records inside the
+    # table's span count as 0. The period holding today is never marked, it is still filling up.
+    import pandas as pd
+    frequency = grain_dict[group_by][1]
+    today = today or date.today()
+    unfinished = pd.Timestamp(snap_to_periods(today, today, group_by)[0])
+    frame = pd.DataFrame(overview_rows, columns=['TABLE_NAME', 'PERIOD', 'RECORDS'])
+    frame['PERIOD'] = pd.to_datetime(frame['PERIOD'])
+    frames = {}
+    for table in overview_tables:
+        records = frame[frame['TABLE_NAME'] == table].set_index('PERIOD')['RECORDS'].astype('int64').sort_index()
+        if not records.empty:
+            records = records.resample(frequency).sum()
+        baseline = records.shift(1).rolling(drop_baseline_periods, min_periods=1).median()
+        drops = (records < baseline * (1 + sharp_drop_threshold / 100)) & (records.index < unfinished)
+        chart = pd.DataFrame({'RECORDS': records.where(~drops, 0), 'SHARP_DROP': records.where(drops, 0)})
+        chart.index.name = 'DATE'
+        frames[table] = (chart, [period.date() for period in records.index[drops]])
+    return frames
+
+
+def rollup_sql(schema, table, first_year, last_year, approximate=False):
+    # a whole-year range on the raw date column keeps micro-partition pruning working
+    col = table_dict[table]
+    patients = "APPROX_COUNT_DISTINCT(PATID)" if approximate else "COUNT(DISTINCT PATID)"
+    return f"""
+        SELECT CASE WHEN GROUPING(D) = 0 THEN 'DAY' WHEN GROUPING(M) = 0 THEN 'MONTH' ELSE 'YEAR' END AS GRAIN,
+               COALESCE(D, M, Y) AS PERIOD,
+               COUNT(*) AS RECORDS,
+               {patients} AS PATIENTS
+        FROM (
+            SELECT DATE_TRUNC('DAY', {col})::DATE AS D, DATE_TRUNC('MONTH', {col})::DATE AS M, DATE_TRUNC('YEAR', {col})::DATE AS Y, PATID
+            FROM {schema}.{table}
+            WHERE {col} >= '{first_year}-01-01' AND {col} < '{last_year + 1}-01-01'
+        )
+        GROUP BY GROUPING SETS ((D), (M), (Y))
+    """
+
+
+def year_runs(years):
+    # consecutive years are fetched together so a gap in the cache costs one statement
+    runs = []
+    for year in sorted(years):
+        if runs and runs[-1][1] == year - 1:
+            runs[-1][1] = year
+        else:
+            runs.append([year, year])
+    return runs
+
+
+def fetch_rollup(session, schema, table, start_date, end_date, cache, approximate=False):
+    # cache: (schema, table, approximate, year) -> rollup rows of that year; years without data are cached empty
+    years = range(start_date.year, end_date.year + 1)
+    missing = [year for year in years if (schema, table, approximate, year) not in cache]
+    for first_year, last_year in year_runs(missing):
+        fetched = {year: [] for year in range(first_year, last_year + 1)}
+        for row in fetch_rows(session, rollup_sql(schema, table, first_year, last_year, approximate), query_tag('trend', [table], schema)):
+            fetched[row['PERIOD'].year].append(row)
+        cache.update({(schema, table, approximate, year): rows for year, rows in fetched.items()})
+    return [row for year in years for row in cache[(schema, table, approximate, year)]]
+
+
+def snap_to_periods(start_date, end_date, group_by):
+    # distinct patients cannot be split below the chosen grain, so the range covers whole periods
+    grain = grain_dict[group_by][0]
+    if grain == 'YEAR':
+        return date(start_date.year, 1, 1), date(end_date.year, 12, 31)
+    if grain == 'MONTH':
+        next_month = date(end_date.year + end_date.month // 12, end_date.month % 12 + 1, 1)
+        return date(start_date.year, start_date.month, 1), next_month - timedelta(days=1)
+    return start_date, end_date
+
+
+def trend_frames(rollup_rows, group_by, start_date, end_date):
+    # (records, patients) frames indexed by period start with a single CT column, as charted
+    import pandas as pd
+    grain, frequency = grain_dict[group_by]
+    start_date, end_date = snap_to_periods(start_date, end_date, group_by)
+    frame = pd.DataFrame(rollup_rows, columns=['GRAIN', 'PERIOD', 'RECORDS', 'PATIENTS'])
+    frame['PERIOD'] = pd.to_datetime(frame['PERIOD'])
+    frame = frame[(frame['PERIOD'] >= pd.Timestamp(start_date)) & (frame['PERIOD'] <= pd.Timestamp(end_date))]
+
+    # records add up, so every grouping is resampled from the daily rows
+    daily = frame[frame['GRAIN'] == 'DAY'].set_index('PERIOD')['RECORDS'].astype('int64')
+    records = daily.resample(frequency).sum()
+    records = records[records > 0].rename('CT').to_frame()
+    records.index.name = 'DATE'
+
+    # distinct patients do not, so they come from the rollup rows of the matching grain
+    patients = frame[frame['GRAIN'] == grain].set_index('PERIOD')['PATIENTS'].astype('int64').sort_index()
+    patients = patients.rename('CT').to_frame()
+    patients.index.name = 'DATE'
+    return records, patients
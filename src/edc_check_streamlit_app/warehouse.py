@@ -0,0 +1,88 @@
+# Single entry point for statements sent to the warehouse; results come back as plain dicts.
+# Every statement runs under the STATEMENT_TIMEOUT_IN_SECONDS budget of its check, and one that
+# exceeds it fails its own check with StatementTimeout while the rest of the report carries on.
+from functools import partial
+
+from query_executor import cancellable
+from query_profiler import parse_tag, profiled, profiled_stream
+
+
+# seconds a statement may run by the check id of its QUERY_TAG; the others get the default
+default_statement_timeout = 1800
+statement_timeouts = {
+    '1.11': 3600,
+    'profile': 3600,
+    'trend': 600,
+}
+
+# Snowflake error number of a statement stopped by its STATEMENT_TIMEOUT_IN_SECONDS
+statement_timeout_errno = 630
+
+# Snowflake error number of "Object '...' does not exist or not authorized"
+missing_object_errno = 2003
+
+
+class StatementTimeout(TimeoutError):
+    pass
+
+
+def statement_timeout(tag):
+    return statement_timeouts.get(parse_tag(tag)[0], default_statement_timeout)
+
+
+def statement_params(tag):
+    params = {'STATEMENT_TIMEOUT_IN_SECONDS': statement_timeout(tag)}
+    if tag:
+        params['QUERY_TAG'] = tag
+    return params
+
+
+def timed_out(error):
+    return isinstance(error, TimeoutError) or getattr(error, 'errno', None) == statement_timeout_errno
+
+
+def missing_object(error):
+    # DuckDB reports a missing table as a CatalogException
+    return getattr(error, 'errno', None) == missing_object_errno or type(error).__name__ == 'CatalogException'
+
+
+def cancel_statement(session, job):
+    # AsyncJob.cancel() sends SYSTEM$CANCEL_QUERY for the job's query id
+    if hasattr(job, 'cancel'):
+        job.cancel()
+    elif getattr(job, 'query_id', None):
+        session.sql(f"SELECT SYSTEM$CANCEL_QUERY('{job.query_id}')").collect()
+
+
+def fetch_rows(session, sql, tag=None):
+    # submitted asynchronously so the statement runs alongside the other checks of the section,
+    # and can be cancelled when the run waiting on it is abandoned; the tag becomes the
+    # statement's QUERY_TAG and names it in the query profile
+    def run():
+        try:
+            job = session.sql(sql).collect_nowait(statement_params=statement_params(tag))
+            with cancellable(partial(cancel_statement, session, job)):
+                rows = job.result()
+        except Exception as error:
+            if not timed_out(error):
+                raise
+            timeout = StatementTimeout(f"timed out after {statement_timeout(tag)} s and was cancelled")
+            timeout.sfqid = getattr(error, 'sfqid', None)
+            raise timeout from error
+        return getattr(job, 'query_id', None), [row.as_dict() for row in rows]
+    return profiled(session, sql, tag, run)
+
+
+def stream_rows(session, sql, tag=None):
+    # rows one at a time as the warehouse returns result batches, for results too large to hold
+    # at once; close the generator to abandon the rest. Submitted as a job, like fetch_rows, so
+    # the profile has the statement's query id.
+    job = session.sql(sql).collect_nowait(statement_params=statement_params(tag))
+    rows = job.result('row_iterator')
+    return profiled_stream(session, sql, tag, (row.as_dict() for row in rows), getattr(job, 'query_id', None))
+
+
+def column_types(session, sql):
+    # (name, Snowpark DataType) of the statement's result columns; DataFrame.schema describes the
+    # statement without running it
+    return [(field.name.strip('"'), field.datatype) for field in session.sql(sql).schema.fields]